@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of maloney_streamfetcher.py against a local stand-in for
+the SRF listing, mediaComposition and MP3 endpoints
+'''
+
+import os
+import io
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+import http.server
+
+SCENARIOS = ['latest', 'backfill', 'cached', 'uid', 'noop']
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|')
+
+class SrfStandIn(http.server.ThreadingHTTPServer):
+    '''
+    Serves episodes like www.srf.ch/aron/api/.../latestEpisodes?page=N,
+    il.srf.ch/integrationlayer/2.0/mediaComposition/byUrn/URN.json and the
+    MP3 files they point to, with configurable latency, bandwidth and errors
+    '''
+    daemon_threads = True
+
+    def __init__(self, episodes=50, latency=0.0, bandwidth=0, error_rate=0.0, mp3_size=1024 * 1024, episode_json_file=None, port=0):
+        http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', port), SrfRequestHandler)
+        self.episodes = episodes
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.mp3_size = mp3_size
+        self.random = random.Random(0)
+        self.lock = threading.Lock()
+        self.titles = []
+        if episode_json_file and os.path.isfile(episode_json_file):
+            with open(episode_json_file, mode='r', encoding="utf-8") as file:
+                self.titles = [item["title"] for item in json.load(file)]
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.errors = 0
+            self.bytes = 0
+
+    def count(self, sent=0, not_modified=False, error=False):
+        with self.lock:
+            self.requests = self.requests + 1
+            self.bytes = self.bytes + sent
+            if not_modified:
+                self.not_modified = self.not_modified + 1
+            if error:
+                self.errors = self.errors + 1
+
+    def inject_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def json_url(self):
+        return self.base_url() + '/integrationlayer/2.0/mediaComposition/byUrn/'
+
+    def episode_list_url(self):
+        return self.base_url() + '/aron/api/audio/shows/A00361/latestEpisodes?page='
+
+    def listing(self, page):
+        # newest episode first, 10 per page
+        first = self.episodes - (page - 1) * 10
+        return [{"assetUrn": "urn:srf:audio:{}".format(i)} for i in range(first, max(first - 10, 0), -1)]
+
+    def media_composition(self, number):
+        if 0 < number <= len(self.titles):
+            title = self.titles[number - 1]
+        else:
+            title = "Episode {}".format(number)
+        date = "2020-{:02d}-{:02d}T20:00:00+01:00".format(number % 12 + 1, number % 28 + 1)
+        return {
+            "episode": {"publishedDate": date},
+            "chapterList": [{
+                "title": title,
+                "lead": "Lead of episode {}".format(number),
+                "date": date,
+                "resourceList": [
+                    {"protocol": "HTTPS", "url": "{}/mp3/{}.mp3".format(self.base_url(), number)},
+                ],
+            }],
+        }
+
+class SrfRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, avoid delayed-ACK stalls on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if server.inject_error():
+            self.send_body(503, b'Service Unavailable', 'text/plain', error=True)
+            return
+
+        match = re.search(r'/latestEpisodes\?page=(\d+)$', self.path)
+        if match:
+            body = json.dumps(server.listing(int(match.group(1)))).encode('utf-8')
+            self.send_body(200, body, 'application/json')
+            return
+        match = re.search(r'/mediaComposition/byUrn/urn:srf:audio:(\d+)\.json$', self.path)
+        if match:
+            body = json.dumps(server.media_composition(int(match.group(1)))).encode('utf-8')
+            self.send_body(200, body, 'application/json')
+            return
+        match = re.search(r'/mp3/(\d+)\.mp3$', self.path)
+        if match:
+            self.send_mp3(int(match.group(1)))
+            return
+        self.send_body(404, b'Not Found', 'text/plain', error=True)
+
+    def send_body(self, status, body, content_type, error=False):
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            self.server.count(not_modified=True)
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.write_throttled(body)
+        self.server.count(len(body), error=error)
+
+    def send_mp3(self, number):
+        size = self.server.mp3_size
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        # MPEG frame sync bytes, so the body looks like audio to mutagen
+        chunk = b'\xff\xfb\x90\x00' * 16384
+        sent = 0
+        try:
+            while sent < size:
+                data = chunk[:size - sent]
+                self.write_throttled(data)
+                sent = sent + len(data)
+        finally:
+            self.server.count(sent)
+
+    def write_throttled(self, data):
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        step = max(1024, bandwidth // 20)
+        for offset in range(0, len(data), step):
+            start = time.monotonic()
+            block = data[offset:offset + step]
+            self.wfile.write(block)
+            remaining = len(block) / bandwidth - (time.monotonic() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+def run_fetcher(scenario, options, json_url, episode_list_url, workdir, results):
+    '''
+    Runs in a child process so peak RSS is measured per scenario
+    '''
+    import resource
+    import maloney_streamfetcher
+
+    outdir = os.path.join(workdir, 'out')
+    cache_dir = os.path.join(workdir, 'cache') if options['cache'] else None
+    library_file = os.path.join(workdir, 'library.json')
+    error = ''
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            downloader = maloney_streamfetcher.MaloneyDownload(
+                episode_json_file=options['episode_json_file'], jobs=options['jobs'],
+                max_connections=options['max_connections'], cache_dir=cache_dir,
+                library_file=library_file, json_url=json_url, episode_list_url=episode_list_url,
+                max_rate=options['max_rate'])
+            if scenario == 'uid':
+                downloader.process_maloney_episodes(None, outdir, uid=str(options['episodes'] // 2 or 1))
+            elif scenario == 'latest' and options['async']:
+                downloader.run_async([1], outdir=outdir)
+            elif scenario == 'latest':
+                downloader.fetch_latest(outdir=outdir)
+            elif options['async']:
+                downloader.run_async(range(1, 20), outdir=outdir)
+            else:
+                downloader.fetch_all(outdir=outdir)
+        except Exception as err:
+            error = '{}: {}'.format(type(err).__name__, err)
+    wall = time.monotonic() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'rss': usage.ru_maxrss,
+        'files': len([name for name in os.listdir(outdir) if name.endswith('.mp3')]),
+        'error': error,
+    })
+
+def run_scenario(server, scenario, options):
+    context = multiprocessing.get_context('spawn')
+    workdir = tempfile.mkdtemp(prefix='maloney-benchmark-')
+    os.makedirs(os.path.join(workdir, 'out'))
+    try:
+        if scenario == 'cached':
+            # warm the cache and the output folder, only the second run is measured
+            run_child(context, server, 'backfill', options, workdir)
+        elif scenario == 'noop':
+            run_child(context, server, 'latest', options, workdir)
+        server.reset()
+        if scenario == 'noop':
+            result = run_script(server, options, workdir)
+        else:
+            result = run_child(context, server, scenario, options, workdir)
+        result.update({
+            'scenario': scenario,
+            'requests': server.requests,
+            'not_modified': server.not_modified,
+            'http_errors': server.errors,
+            'bytes': server.bytes,
+        })
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_child(context, server, scenario, options, workdir):
+    results = context.Queue()
+    process = context.Process(target=run_fetcher, args=(scenario, options, server.json_url(), server.episode_list_url(), workdir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+def run_script(server, options, workdir):
+    '''
+    Runs maloney_streamfetcher.py -l as a cron job would, in a fresh
+    interpreter with -X importtime, over an output folder that already has
+    the latest episodes
+    '''
+    outdir = os.path.join(workdir, 'out')
+    command = [sys.executable, '-X', 'importtime', os.path.join(os.path.dirname(os.path.realpath(__file__)), 'maloney_streamfetcher.py'),
+               '-l', '-o', outdir, '--library-file', os.path.join(workdir, 'library.json'),
+               '--episode-list-url', server.episode_list_url(), '--json-url', server.json_url()]
+    command += ['--cache-dir', os.path.join(workdir, 'cache')] if options['cache'] else ['--no-cache']
+    if options['episode_json_file']:
+        command += ['-j', options['episode_json_file']]
+    start = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    stderr = process.stderr.read()
+    process.stderr.close()
+    # wait4 returns the resource usage of this child alone
+    (pid, status, usage) = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - start
+    imports = 0
+    errors = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            imports = imports + int(match.group(1))
+        elif line.strip() and not line.startswith('import time:'):
+            errors.append(line.strip())
+    if process.returncode:
+        errors.append('exit status {}'.format(process.returncode))
+    return {
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'imports': imports / 1000000,
+        'rss': usage.ru_maxrss,
+        'files': len([name for name in os.listdir(outdir) if name.endswith('.mp3')]),
+        'error': errors[-1] if errors else '',
+    }
+
+def print_results(results):
+    print("{:<10} {:>9} {:>9} {:>12} {:>9} {:>6} {:>11} {:>10} {:>7} {:>7}  {}".format(
+        'scenario', 'wall [s]', 'CPU [s]', 'imports [s]', 'requests', '304', 'bytes [MB]', 'RSS [MB]', 'files', 'errors', ''))
+    for result in results:
+        print("{:<10} {:>9.2f} {:>9.3f} {:>12} {:>9} {:>6} {:>11.1f} {:>10.1f} {:>7} {:>7}  {}".format(
+            result['scenario'], result['wall'], result['cpu'],
+            '{:.3f}'.format(result['imports']) if 'imports' in result else '-',
+            result['requests'], result['not_modified'],
+            result['bytes'] / 1024 / 1024, result['rss'] / 1024, result['files'],
+            result['http_errors'], result['error']))
+
+if __name__ == "__main__":
+    path = os.path.split(os.path.realpath(__file__))[0]
+
+    parser = argparse.ArgumentParser(description = 'Benchmark maloney_streamfetcher against a local SRF stand-in')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS, dest='scenarios', help='Scenario to run, can be given several times (default: all).')
+    parser.add_argument('-n', '--episodes', type=int, default=50, dest='episodes', help='Number of episodes the stand-in publishes.')
+    parser.add_argument('--latency', type=float, default=20, dest='latency', help='Latency of every response in ms.')
+    parser.add_argument('--bandwidth', type=int, default=0, dest='bandwidth', help='Bandwidth per connection in KB/s, 0 for unlimited.')
+    parser.add_argument('--error-rate', type=float, default=0.0, dest='error_rate', help='Fraction of requests answered with 503.')
+    parser.add_argument('--mp3-size', type=int, default=1024, dest='mp3_size', help='Size of every MP3 in KB.')
+    parser.add_argument('-J', '--jobs', type=int, default=1, dest='jobs', help='Passed to MaloneyDownload.')
+    parser.add_argument('--max-connections', type=int, default=4, dest='max_connections', help='Passed to MaloneyDownload.')
+    parser.add_argument('--max-rate', type=int, dest='max_rate', help='Passed to MaloneyDownload, in KB/s.')
+    parser.add_argument('--no-cache', action='store_false', dest='cache', help='Run without the metadata cache.')
+    parser.add_argument('--async', action='store_true', dest='use_async', help='Use the asyncio engine.')
+    parser.add_argument('-j', '--json-data', dest='json', default=path + '/episode-data.json', help='Episode info used for titles and by the fetcher.')
+    parser.add_argument('--cpu-budget', type=float, dest='cpu_budget', help='Exit with status 1 if the noop scenario takes more CPU time, in ms.')
+    args = parser.parse_args()
+
+    server = SrfStandIn(episodes=args.episodes, latency=args.latency / 1000, bandwidth=args.bandwidth * 1024,
+                        error_rate=args.error_rate, mp3_size=args.mp3_size * 1024, episode_json_file=args.json)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    options = {
+        'episodes': args.episodes,
+        'jobs': args.jobs,
+        'max_connections': args.max_connections,
+        'cache': args.cache,
+        'max_rate': args.max_rate * 1024 if args.max_rate else None,
+        'async': args.use_async,
+        'episode_json_file': args.json,
+    }
+    results = []
+    try:
+        for scenario in args.scenarios or SCENARIOS:
+            results.append(run_scenario(server, scenario, options))
+    finally:
+        server.shutdown()
+    print_results(results)
+
+    if args.cpu_budget is not None:
+        for result in results:
+            if result['scenario'] == 'noop' and result['cpu'] * 1000 > args.cpu_budget:
+                sys.exit("noop run took {:.0f} ms CPU, budget is {:.0f} ms".format(result['cpu'] * 1000, args.cpu_budget))
@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+import threading
+import unicodedata
+from library_index import normalize_title
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+def open_catalog(episode_file, writable=False):
+    '''
+    SqliteEpisodeCatalog for .db/.sqlite files, EpisodeCatalog for JSON
+    '''
+    if episode_file and episode_file.endswith(SQLITE_EXTENSIONS):
+        return SqliteEpisodeCatalog(episode_file, writable=writable)
+    return EpisodeCatalog.load(episode_file)
+
+class EpisodeCatalog:
+    '''
+    Episode information from episode-data.json, indexed by uid, episode number,
+    title and alternative titles
+    '''
+
+    def __init__(self, episodes=None):
+        self.episodes = episodes if episodes is not None else []
+        self.reindex()
+
+    @classmethod
+    def load(cls, episode_json_file):
+        if not episode_json_file or not os.path.isfile(episode_json_file):
+            return cls()
+        with open(episode_json_file, mode='r', encoding="utf-8") as file:
+            json_string = file.read()
+            json_string = unicodedata.normalize('NFKD', json_string).encode('utf-8','ignore')
+            return cls(json.loads(json_string))
+
+    def save(self, episode_json_file):
+        with open(episode_json_file, mode='w', encoding="utf-8") as file:
+            file.write(json.dumps(self.episodes))
+
+    def reindex(self):
+        self.uids = {}
+        self.numbers = {}
+        self.titles = {}
+        self.alternative_titles = {}
+        for item in self.episodes:
+            self.index(item)
+
+    def index(self, item):
+        # first entry wins, like a linear scan over the list would
+        if "uid" in item:
+            self.uids.setdefault(item["uid"], item)
+        self.numbers.setdefault(item["episode"], item)
+        self.titles.setdefault(item["title"], item)
+        for title in item.get("alternative_titles", []):
+            self.alternative_titles.setdefault(title, item)
+
+    def add(self, item):
+        self.episodes.append(item)
+        self.index(item)
+
+    def update(self, item, **fields):
+        '''
+        Change fields of a catalog entry and keep the indexes consistent
+        '''
+        old_uid = item.get("uid")
+        item.update(fields)
+        if "uid" in fields and old_uid != item["uid"]:
+            if old_uid is not None and self.uids.get(old_uid) is item:
+                del self.uids[old_uid]
+                # another entry may have carried the same uid
+                for other in self.episodes:
+                    if other.get("uid") == old_uid:
+                        self.uids[old_uid] = other
+                        break
+            self.uids.setdefault(item["uid"], item)
+
+    def by_uid(self, uid):
+        return self.uids.get(uid)
+
+    def by_episode(self, number):
+        return self.numbers.get(number)
+
+    def by_title(self, title):
+        episode_info = self.titles.get(title)
+        if episode_info is None:
+            episode_info = self.alternative_titles.get(title)
+        return episode_info
+
+    def __len__(self):
+        return len(self.episodes)
+
+    def __iter__(self):
+        return iter(self.episodes)
+
+def title_trigrams(key):
+    # normalized titles are alphanumeric, so the padding never occurs in them
+    padded = '$$' + key + '$'
+    return set(padded[offset:offset + 3] for offset in range(len(padded) - 2))
+
+class TitleMatcher:
+    '''
+    Finds catalog entries by title and alternative titles, tolerating the
+    differences between SRF titles and the catalog
+
+    Titles are compared normalized, so case, accents, punctuation and
+    whitespace never prevent a match. Other titles are looked up in a
+    trigram index and match if the Dice coefficient of their trigrams
+    reaches threshold and beats every other entry by at least margin.
+    Distinct episodes in episode-data.json reach 0.81 ("Die Tankstelle" and
+    "Die neue Tankstelle"), so the threshold must stay well above that.
+    '''
+
+    def __init__(self, episodes, threshold=0.9, margin=0.1):
+        self.threshold = threshold
+        self.margin = margin
+        self.keys = {}
+        self.trigrams = {}
+        self.entries = []
+        for item in episodes:
+            for title in [item.get("title")] + item.get("alternative_titles", []):
+                key = normalize_title(title or '')
+                # first entry wins, as in EpisodeCatalog
+                if not key or key in self.keys:
+                    continue
+                self.keys[key] = item
+                trigrams = title_trigrams(key)
+                for trigram in trigrams:
+                    self.trigrams.setdefault(trigram, []).append(len(self.entries))
+                self.entries.append((len(trigrams), item))
+
+    def closest(self, title):
+        '''
+        Returns (entry, score, lead) of the most similar title. score is 1.0
+        for titles equal after normalization, lead is how far score is ahead
+        of the best title of another entry. (None, 0.0, 0.0) if no trigram is
+        shared.
+        '''
+        key = normalize_title(title)
+        if key in self.keys:
+            return (self.keys[key], 1.0, 1.0)
+        trigrams = title_trigrams(key)
+        shared = {}
+        for trigram in trigrams:
+            for index in self.trigrams.get(trigram, ()):
+                shared[index] = shared.get(index, 0) + 1
+        (best, best_score) = (None, 0.0)
+        runner_up = 0.0
+        for index, count in shared.items():
+            score = 2.0 * count / (len(trigrams) + self.entries[index][0])
+            if score > best_score or (score == best_score and index < best):
+                # alternative titles of the same entry do not compete
+                if best is not None and self.entries[best][1] is not self.entries[index][1]:
+                    runner_up = best_score
+                (best, best_score) = (index, score)
+            elif score > runner_up and self.entries[best][1] is not self.entries[index][1]:
+                runner_up = score
+        if best is None:
+            return (None, 0.0, 0.0)
+        return (self.entries[best][1], best_score, best_score - runner_up)
+
+    def accepts(self, score, lead):
+        return score == 1.0 or (score >= self.threshold and lead >= self.margin)
+
+    def match(self, title):
+        '''
+        The entry of title, None if no title is similar enough
+        '''
+        (episode_info, score, lead) = self.closest(title)
+        return episode_info if self.accepts(score, lead) else None
+
+class SqliteEpisodeCatalog:
+    '''
+    Episode catalog in a SQLite database with indexed episode, title,
+    alternative title, uid and date columns
+
+    Same interface as EpisodeCatalog. If writable, update() commits every
+    change in its own transaction, so nothing learned before a crash is lost.
+    '''
+
+    columns = ('episode', 'date', 'title', 'uid', 'lead')
+
+    def __init__(self, database, writable=False):
+        self.database = database
+        self.writable = writable
+        self.lock = threading.Lock()
+        # one dict per row, so update() can find the row of an item it returned
+        self.rows = {}
+        self.rowids = {}
+        # only loaded for SQLite catalogs, JSON ones are read on every fetcher start
+        import sqlite3
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS episodes (
+                id INTEGER PRIMARY KEY,
+                episode TEXT NOT NULL,
+                date TEXT,
+                title TEXT,
+                uid TEXT,
+                lead TEXT,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS alternative_titles (
+                episode_id INTEGER NOT NULL REFERENCES episodes(id) ON DELETE CASCADE,
+                title TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS episodes_episode ON episodes(episode);
+            CREATE INDEX IF NOT EXISTS episodes_title ON episodes(title);
+            CREATE INDEX IF NOT EXISTS episodes_uid ON episodes(uid);
+            CREATE INDEX IF NOT EXISTS episodes_date ON episodes(date);
+            CREATE INDEX IF NOT EXISTS alternative_titles_title ON alternative_titles(title);
+            CREATE INDEX IF NOT EXISTS alternative_titles_episode_id ON alternative_titles(episode_id);
+        ''')
+        self.connection.execute('PRAGMA foreign_keys = ON')
+
+    def import_episodes(self, episodes):
+        '''
+        Replace the database content with the entries of an episode list
+        '''
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM alternative_titles')
+            self.connection.execute('DELETE FROM episodes')
+            for item in episodes:
+                extra = {key: value for key, value in item.items() if key not in self.columns and key != 'alternative_titles'}
+                cursor = self.connection.execute(
+                    'INSERT INTO episodes (episode, date, title, uid, lead, extra) VALUES (?, ?, ?, ?, ?, ?)',
+                    [item.get(column) for column in self.columns] + [json.dumps(extra) if extra else None])
+                self.connection.executemany(
+                    'INSERT INTO alternative_titles (episode_id, title) VALUES (?, ?)',
+                    [(cursor.lastrowid, title) for title in item.get('alternative_titles', [])])
+            self.rows = {}
+            self.rowids = {}
+
+    def export_episodes(self):
+        return list(self)
+
+    def save(self, episode_json_file):
+        if os.path.abspath(episode_json_file) == os.path.abspath(self.database):
+            with self.lock:
+                self.connection.commit()
+            return
+        with open(episode_json_file, mode='w', encoding="utf-8") as file:
+            file.write(json.dumps(self.export_episodes()))
+
+    def item(self, row):
+        '''
+        The dict of a row, in the layout of an episode-data.json entry
+        '''
+        rowid = row[0]
+        if rowid in self.rows:
+            return self.rows[rowid]
+        # same key order as in episode-data.json, where lead and uid are appended
+        (episode, date, title, uid, lead, extra) = row[1:]
+        item = {"episode": episode}
+        if date is not None:
+            item["date"] = date
+        if title is not None:
+            item["title"] = title
+        alternative_titles = [title for (title,) in self.connection.execute(
+            'SELECT title FROM alternative_titles WHERE episode_id = ? ORDER BY rowid', (rowid,))]
+        if alternative_titles:
+            item['alternative_titles'] = alternative_titles
+        if extra:
+            item.update(json.loads(extra))
+        if lead is not None:
+            item["lead"] = lead
+        if uid is not None:
+            item["uid"] = uid
+        self.rows[rowid] = item
+        self.rowids[id(item)] = rowid
+        return item
+
+    def query(self, where, parameters):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT id, episode, date, title, uid, lead, extra FROM episodes WHERE ' + where + ' ORDER BY id LIMIT 1',
+                parameters).fetchone()
+            if row is None:
+                return None
+            return self.item(row)
+
+    def update(self, item, **fields):
+        item.update(fields)
+        columns = [column for column in fields if column in self.columns]
+        if not self.writable or not columns:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE episodes SET ' + ', '.join('{} = ?'.format(column) for column in columns) + ' WHERE id = ?',
+                [fields[column] for column in columns] + [self.rowids[id(item)]])
+
+    def by_uid(self, uid):
+        return self.query('uid = ?', (uid,))
+
+    def by_episode(self, number):
+        return self.query('episode = ?', (number,))
+
+    def by_title(self, title):
+        episode_info = self.query('title = ?', (title,))
+        if episode_info is None:
+            episode_info = self.query('id = (SELECT episode_id FROM alternative_titles WHERE title = ? ORDER BY episode_id LIMIT 1)', (title,))
+        return episode_info
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM episodes').fetchone()[0]
+
+    def __iter__(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT id, episode, date, title, uid, lead, extra FROM episodes ORDER BY id').fetchall()
+            return iter([self.item(row) for row in rows])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Convert the episode catalog between JSON and SQLite')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='Import a JSON catalog into a SQLite database, replacing its content.')
+    import_parser.add_argument('json', help='episode-data.json')
+    import_parser.add_argument('database', help='SQLite database')
+    export_parser = subparsers.add_parser('export', help='Export a SQLite database to a JSON catalog.')
+    export_parser.add_argument('database', help='SQLite database')
+    export_parser.add_argument('json', help='episode-data.json')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        if not os.path.isfile(args.json):
+            sys.exit("No such file: {}".format(args.json))
+        catalog = SqliteEpisodeCatalog(args.database)
+        catalog.import_episodes(EpisodeCatalog.load(args.json))
+        print("Imported {} episodes into {}".format(len(catalog), args.database))
+    else:
+        if not os.path.isfile(args.database):
+            sys.exit("No such file: {}".format(args.database))
+        catalog = SqliteEpisodeCatalog(args.database)
+        catalog.save(args.json)
+        print("Exported {} episodes to {}".format(len(catalog), args.json))
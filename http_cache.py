@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+class CacheMiss(Exception):
+    pass
+
+class HttpCache:
+    '''
+    On-disk cache for HTTP responses, keyed by URL
+
+    Every entry keeps the body plus the ETag and Last-Modified headers of the
+    response. Entries younger than the TTL of their endpoint are served as is,
+    older ones are revalidated with a conditional request. When the bodies
+    exceed max_size the least recently used entries are evicted.
+    '''
+
+    # (url substring, seconds) - the first matching rule applies
+    default_ttls = [
+        ('/latestEpisodes', 0),                    # always revalidate listing pages
+        ('/mediaComposition/', 7 * 24 * 60 * 60),  # published metadata rarely changes
+    ]
+    default_ttl = 0
+
+    def __init__(self, directory, max_size=50 * 1024 * 1024, ttls=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttls = ttls if ttls is not None else self.default_ttls
+        self.lock = threading.Lock()
+        self.dirty = False
+        # keys dropped by this process, so a flush does not merge them back
+        self.removed = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = self.load_index()
+
+    def load_index(self):
+        try:
+            with open(self.index_file(), mode='r', encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def index_file(self):
+        return os.path.join(self.directory, 'index.json')
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def body_file(self, key):
+        return os.path.join(self.directory, key + '.body')
+
+    def temp_file(self, filename):
+        # unique per process and thread, several of them may share the cache
+        return "{}.{}-{}.tmp".format(filename, os.getpid(), threading.get_ident())
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern in url:
+                return ttl
+        return self.default_ttl
+
+    def lookup(self, url):
+        '''
+        Returns (body, fresh) for a cached url or (None, False) if there is no
+        usable entry
+        '''
+        key = self.key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return (None, False)
+            try:
+                with open(self.body_file(key), mode='rb') as file:
+                    body = file.read()
+            except OSError:
+                del self.entries[key]
+                self.removed.add(key)
+                self.dirty = True
+                return (None, False)
+            entry['accessed'] = time.time()
+            self.dirty = True
+            fresh = time.time() - entry['stored'] < self.ttl(url)
+            return (body, fresh)
+
+    def get(self, url):
+        '''
+        Returns the cached body regardless of its age, raises CacheMiss
+        '''
+        body = self.lookup(url)[0]
+        if body is None:
+            raise CacheMiss("Not in cache: {}".format(url))
+        return body
+
+    def conditional_headers(self, url):
+        entry = self.entries.get(self.key(url))
+        headers = []
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers.append('If-None-Match: {}'.format(entry['etag']))
+        if entry.get('last_modified'):
+            headers.append('If-Modified-Since: {}'.format(entry['last_modified']))
+        return headers
+
+    def store(self, url, headers, body):
+        key = self.key(url)
+        temp_file = self.temp_file(self.body_file(key))
+        with open(temp_file, mode='wb') as file:
+            file.write(body)
+        os.replace(temp_file, self.body_file(key))
+        now = time.time()
+        with self.lock:
+            self.removed.discard(key)
+            self.entries[key] = {
+                'url': url,
+                'etag': headers.get('etag', ''),
+                'last_modified': headers.get('last-modified', ''),
+                'stored': now,
+                'accessed': now,
+                'size': len(body),
+            }
+            self.dirty = True
+        self.evict()
+
+    def revalidated(self, url, headers):
+        '''
+        Mark a cached url as fresh after a 304 Not Modified response
+        '''
+        with self.lock:
+            entry = self.entries.get(self.key(url))
+            if entry is None:
+                return
+            entry['stored'] = entry['accessed'] = time.time()
+            if headers.get('etag'):
+                entry['etag'] = headers['etag']
+            if headers.get('last-modified'):
+                entry['last_modified'] = headers['last-modified']
+            self.dirty = True
+
+    def evict(self):
+        with self.lock:
+            size = sum(entry['size'] for entry in self.entries.values())
+            if size <= self.max_size:
+                return
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['accessed']):
+                if size <= self.max_size:
+                    break
+                try:
+                    os.remove(self.body_file(key))
+                except OSError:
+                    pass
+                size = size - entry['size']
+                del self.entries[key]
+                self.removed.add(key)
+            self.dirty = True
+
+    def flush(self):
+        '''
+        Write the index, merged with the entries other processes stored in the
+        meantime. Callers sharing the cache between processes should hold a
+        lock around it, or the last flush wins.
+        '''
+        with self.lock:
+            if not self.dirty:
+                return
+            entries = self.load_index()
+            for key in self.removed:
+                entries.pop(key, None)
+            for key, entry in self.entries.items():
+                if key not in entries or entry['accessed'] >= entries[key]['accessed']:
+                    entries[key] = entry
+            temp_file = self.temp_file(self.index_file())
+            try:
+                with open(temp_file, mode='w', encoding="utf-8") as file:
+                    json.dump(entries, file)
+                os.replace(temp_file, self.index_file())
+            except OSError:
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+                raise
+            self.entries = entries
+            self.removed = set()
+            self.dirty = False
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import threading
+import unicodedata
+
+FILENAME_PATTERN = re.compile(r'^Philip Maloney - (?P<number>\S+) - (?P<title>.*) \((?P<date>[0-9-]+)\)$')
+
+def normalize_title(title):
+    '''
+    Case-folded title without accents, punctuation and whitespace
+    '''
+    title = unicodedata.normalize('NFKD', title)
+    return ''.join(char for char in title.casefold() if char.isalnum())
+
+class LibraryIndex:
+    '''
+    Index of the episodes in an output directory tree by episode number,
+    normalized title and uid
+
+    The index is kept in index_file between runs together with the mtime of
+    every directory, so a refresh only lists directories that changed.
+    '''
+
+    def __init__(self, directory, index_file=None):
+        self.directory = os.path.abspath(directory)
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        self.directories = {}
+        self.scanned = 0
+        if index_file and os.path.isfile(index_file):
+            try:
+                with open(index_file, mode='r', encoding="utf-8") as file:
+                    self.directories = json.load(file).get(self.directory, {})
+            except ValueError:
+                self.directories = {}
+        self.refresh()
+
+    def refresh(self):
+        directories = {}
+        self.scanned = 0
+        pending = ['']
+        while pending:
+            relpath = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.directory, relpath)).st_mtime
+            except OSError:
+                continue
+            known = self.directories.get(relpath)
+            if known is not None and known["mtime"] == mtime:
+                entry = known
+            else:
+                entry = self.scan_directory(relpath, mtime, known)
+                self.scanned = self.scanned + 1
+            directories[relpath] = entry
+            pending.extend(entry["subdirectories"])
+        with self.lock:
+            self.directories = directories
+            self.reindex()
+
+    def scan_directory(self, relpath, mtime, known=None):
+        known_files = known["files"] if known else {}
+        files = {}
+        subdirectories = []
+        with os.scandir(os.path.join(self.directory, relpath)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirectories.append(os.path.join(relpath, entry.name))
+                elif entry.name.lower().endswith('.mp3'):
+                    info = self.parse_filename(entry.name)
+                    if entry.name in known_files:
+                        info["uid"] = known_files[entry.name].get("uid", "")
+                    files[entry.name] = info
+        return {"mtime": mtime, "files": files, "subdirectories": subdirectories}
+
+    def parse_filename(self, name):
+        stem = os.path.splitext(name)[0]
+        stem = unicodedata.normalize('NFKD', stem)
+        match = FILENAME_PATTERN.match(stem)
+        if match:
+            return {"number": match.group('number'), "title": match.group('title'), "uid": ""}
+        # files named by renamer.py input conventions: uid, episode number or title
+        if stem.isdigit():
+            return {"number": stem, "title": "", "uid": ""}
+        return {"number": "", "title": stem, "uid": ""}
+
+    def reindex(self):
+        self.numbers = {}
+        self.titles = {}
+        self.uids = {}
+        for relpath, entry in self.directories.items():
+            for name, info in entry["files"].items():
+                self.index(os.path.join(self.directory, relpath, name), info)
+
+    def index(self, path, info):
+        if info["number"].isdigit():
+            self.numbers.setdefault(info["number"], path)
+        if info["title"]:
+            self.titles.setdefault(normalize_title(info["title"]), path)
+        if info.get("uid"):
+            self.uids.setdefault(info["uid"], path)
+
+    def find(self, number=None, title=None, uid=None):
+        '''
+        Returns the path of an existing file for the episode or None. Titles are
+        only compared for episodes without a known number.
+        '''
+        with self.lock:
+            if uid and uid in self.uids:
+                return self.uids[uid]
+            if number:
+                return self.numbers.get(number)
+            if title:
+                return self.titles.get(normalize_title(title))
+        return None
+
+    def add(self, path, number="", title="", uid=""):
+        relpath, name = os.path.split(os.path.relpath(os.path.abspath(path), self.directory))
+        info = {"number": number, "title": title, "uid": uid}
+        with self.lock:
+            entry = self.directories.setdefault(relpath, {"mtime": 0, "files": {}, "subdirectories": []})
+            entry["files"][name] = info
+            self.index(os.path.abspath(path), info)
+
+    def merge(self, stored):
+        '''
+        Directories of this index merged into stored, as saved by another
+        process. Files only the other process knows are kept and the mtime of
+        their directory reset, so the next refresh rescans it.
+        '''
+        merged = dict(stored)
+        for relpath, entry in self.directories.items():
+            other = stored.get(relpath)
+            if other is None or all(name in entry["files"] for name in other["files"]):
+                merged[relpath] = entry
+                continue
+            files = dict(other["files"])
+            files.update(entry["files"])
+            subdirectories = sorted(set(other["subdirectories"]) | set(entry["subdirectories"]))
+            merged[relpath] = {"mtime": 0, "files": files, "subdirectories": subdirectories}
+        return merged
+
+    def save(self):
+        '''
+        Write the index, merged with the one other processes saved in the
+        meantime. Processes sharing index_file should hold a lock around it,
+        or the last save wins.
+        '''
+        if not self.index_file:
+            return
+        with self.lock:
+            data = {}
+            if os.path.isfile(self.index_file):
+                try:
+                    with open(self.index_file, mode='r', encoding="utf-8") as file:
+                        data = json.load(file)
+                except ValueError:
+                    data = {}
+            data[self.directory] = self.merge(data.get(self.directory, {}))
+            # unique per process and thread, several of them may share index_file
+            temp_file = "{}.{}-{}.tmp".format(self.index_file, os.getpid(), threading.get_ident())
+            try:
+                with open(temp_file, mode='w', encoding="utf-8") as file:
+                    json.dump(data, file)
+                os.replace(temp_file, self.index_file)
+            except OSError:
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+                raise
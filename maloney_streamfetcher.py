@@ -2,15 +2,181 @@
 #-------------------------------------------------------------------------------
 # Import modules
 #
+# pycurl, asyncio, urllib and mutagen are imported where they are used, so a
+# run without new episodes does not pay for loading them
+#
 import io
 import os
-import shutil
 import argparse
+import collections
+import contextlib
+import queue
+import signal
+import threading
 import unicodedata
 import json
-from urllib.request import urlopen
-import pycurl
-import certifi
+import time
+import random
+import hashlib
+import importlib.util
+from episode_catalog import open_catalog, TitleMatcher
+from http_cache import HttpCache, CacheMiss
+from library_index import LibraryIndex
+from manifest import MANIFEST_NAME, AudioFilter, LibraryManifest
+from metrics import Metrics
+from rate_control import TokenBucket, AdaptiveLimit
+
+CurlResponse = collections.namedtuple('CurlResponse', ['status', 'headers', 'body'])
+
+def ca_bundle():
+  '''
+  Path of certifi's CA bundle, without importing certifi and the
+  importlib.resources machinery it loads where possible
+  '''
+  spec = importlib.util.find_spec('certifi')
+  if spec is not None and spec.submodule_search_locations:
+    cafile = os.path.join(spec.submodule_search_locations[0], 'cacert.pem')
+    if os.path.isfile(cafile):
+      return cafile
+  # e.g. a distribution package pointing to the system bundle
+  import certifi
+  return certifi.where()
+
+#-------------------------------------------------------------------------------
+# Class Curl Pool
+#
+class CurlPool:
+  '''
+  Keeps pycurl handles and their connections alive across requests and fetches
+  several URLs concurrently through one CurlMulti
+  '''
+  max_connections = 4
+  adaptive = None
+  bucket = None
+
+  def __init__(self, max_connections=4, adaptive=False, bucket=None, timeout=30):
+    self.max_connections = max(1, max_connections)
+    self.timeout = timeout
+    if adaptive:
+      self.adaptive = AdaptiveLimit(self.max_connections)
+    self.bucket = bucket
+    self.handles = []
+    self.lock = threading.Lock()
+    self.cainfo = ca_bundle()
+    import pycurl
+    self.multi = pycurl.CurlMulti()
+    self.multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, self.max_connections)
+
+  def new_handle(self):
+    import pycurl
+    c = pycurl.Curl()
+    c.setopt(pycurl.CAINFO, self.cainfo)
+    # a stalled connection fails with E_OPERATION_TIMEDOUT instead of hanging
+    c.setopt(pycurl.CONNECTTIMEOUT, self.timeout)
+    c.setopt(pycurl.LOW_SPEED_LIMIT, 1)
+    c.setopt(pycurl.LOW_SPEED_TIME, self.timeout)
+    return c
+
+  def fetch(self, url):
+    return self.fetch_all([url])[0]
+
+  def fetch_all(self, urls):
+    return [response.body.decode("utf-8") for response in self.request_all([(url, []) for url in urls])]
+
+  def request_all(self, requests, callback=None):
+    '''
+    Perform all (url, headers) requests with at most max_connections transfers
+    in flight, the responses are returned in the order of requests. If given,
+    callback(index, response) is called as soon as a response is complete.
+    An exception raised by callback is raised once all transfers are done.
+    '''
+    import pycurl
+    results = [None] * len(requests)
+    errors = []
+    callback_errors = []
+    pending = collections.deque(enumerate(requests))
+    in_flight = set()
+    with self.lock:
+      try:
+        # after a callback error only the running transfers are completed
+        while (pending and not callback_errors) or in_flight:
+          while pending and not callback_errors and len(in_flight) < self.concurrency():
+            index, (url, headers) = pending.popleft()
+            c = self.handles.pop() if self.handles else self.new_handle()
+            c.index = index
+            c.buffer = io.BytesIO()
+            c.headers = {}
+            c.setopt(pycurl.URL, url)
+            c.setopt(pycurl.HTTPHEADER, headers)
+            c.setopt(pycurl.WRITEDATA, c.buffer)
+            c.setopt(pycurl.HEADERFUNCTION, lambda line, headers=c.headers: self.parse_header(line, headers))
+            self.multi.add_handle(c)
+            in_flight.add(c)
+          while True:
+            ret, num_handles = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+              break
+          while True:
+            num_queued, ok_list, err_list = self.multi.info_read()
+            for c in ok_list:
+              results[c.index] = CurlResponse(c.getinfo(pycurl.RESPONSE_CODE), c.headers, c.buffer.getvalue())
+              if self.adaptive:
+                self.adaptive.record(c.getinfo(pycurl.STARTTRANSFER_TIME), results[c.index].status)
+              if self.bucket:
+                self.bucket.consume(len(results[c.index].body))
+            for c, errno, errmsg in err_list:
+              errors.append((errno, "{}: {}".format(requests[c.index][0], errmsg)))
+              if self.adaptive:
+                self.adaptive.record()
+            for c in ok_list + [err[0] for err in err_list]:
+              self.recycle(c)
+              in_flight.discard(c)
+            # after recycling, so the pool stays usable whatever callback does
+            for c in ok_list:
+              if callback and not callback_errors:
+                try:
+                  callback(c.index, results[c.index])
+                except Exception as err:
+                  callback_errors.append(err)
+            if num_queued == 0:
+              break
+          if in_flight:
+            self.multi.select(1.0)
+      finally:
+        # interrupted: detach unfinished transfers, the next call must not see them
+        for c in in_flight:
+          self.recycle(c)
+    if callback_errors:
+      raise callback_errors[0]
+    if errors:
+      raise pycurl.error(*errors[0])
+    return results
+
+  def recycle(self, c):
+    self.multi.remove_handle(c)
+    c.buffer = None
+    c.headers = None
+    self.handles.append(c)
+
+  def concurrency(self):
+    if self.adaptive:
+      return self.adaptive.limit
+    return self.max_connections
+
+  def parse_header(self, line, headers):
+    line = line.decode('iso-8859-1')
+    if line.startswith('HTTP/'):
+      headers.clear()
+    elif ':' in line:
+      name, value = line.split(':', 1)
+      headers[name.strip().lower()] = value.strip()
+
+  def close(self):
+    with self.lock:
+      for c in self.handles:
+        c.close()
+      self.handles = []
+      self.multi.close()
 
 #-------------------------------------------------------------------------------
 # Class Maloney Download
@@ -20,113 +186,453 @@ class MaloneyDownload:
   Downloads Maloney Episodes
   '''
   verbose = False
-  episode_data = []
+  catalog = None
+  cache = None
+  bucket = None
+  download_limit = None
+  retries = 3
+  retry_delay = 1.0
+  timeout = 30
+  offline = False
+  state_file = None
+  state = None
+  library_file = None
+  jobs = 1
+  chunk_size = 64 * 1024
+  tag_padding = 4096
+  queue_depth = 0 # episodes resolved ahead of the downloads, 0 for twice jobs
+  worker_id = None
+  lease = 300
+  title_matcher = None
+  match_threshold = 0.9
+
+  # Constants
+  temp_directory   = "./temp"
+  #json_url = "https://il.srgssr.ch/integrationlayer/2.0/srf/mediaComposition/audio/"
+  #json_url = "https://il.srgssr.ch/integrationlayer/2.0/mediaComposition/byUrn/urn:srf:audio:"
+  json_url = "https://il.srf.ch/integrationlayer/2.0/mediaComposition/byUrn/"
+  episode_list_url = "https://www.srf.ch/aron/api/audio/shows/A00361/latestEpisodes?page="
 
-  def __init__(self, verbose=False, episode_json_file=''):
-    # Change to script location
+  def __init__(self, verbose=False, episode_json_file='', jobs=1, max_connections=4, cache_dir=None, cache_size=50 * 1024 * 1024, offline=False, state_file=None, library_file=None, json_url=None, episode_list_url=None, write_catalog=False, max_rate=None, adaptive=True, retries=3, retry_delay=1.0, timeout=30, worker_id=None, lease=300, match_threshold=0.9):
     path,file=os.path.split(os.path.realpath(__file__))
-    os.chdir(path)
     self.path = path
+    self.temp_directory = os.path.join(path, "temp")
+    if worker_id:
+      # workers sharing the script directory keep their partial files apart
+      self.worker_id = worker_id
+      self.temp_directory = os.path.join(self.temp_directory, worker_id)
+    self.lease = lease
+    self.match_threshold = match_threshold
     self.verbose = verbose
-    if os.path.isfile(episode_json_file):
-        with open(episode_json_file, mode='r') as f:
-            json_string = f.read()
-            json_string = unicodedata.normalize('NFKD', json_string).encode('utf-8','ignore')
-            self.episode_data = json.loads(json_string)
+    self.jobs = max(1, jobs)
+    if json_url:
+      self.json_url = json_url
+    if episode_list_url:
+      self.episode_list_url = episode_list_url
+    self.retries = retries
+    self.retry_delay = retry_delay
+    self.timeout = timeout
+    self.bucket = TokenBucket(max_rate) if max_rate else None
+    self.download_limit = AdaptiveLimit(self.jobs) if adaptive else None
+    self.curl = CurlPool(max_connections, adaptive=adaptive, bucket=self.bucket, timeout=timeout)
+    self.catalog = open_catalog(episode_json_file, writable=write_catalog)
+    if cache_dir:
+      self.cache = HttpCache(cache_dir, max_size=cache_size)
+    elif offline:
+      raise ValueError("Offline mode needs a cache directory")
+    self.offline = offline
+    self.library_file = library_file
+    self.libraries = {}
+    self.manifests = {}
+    self.work_queues = {}
+    self.matcher_lock = threading.Lock()
+    self.cancelled = threading.Event()
+    self.metrics = Metrics()
+    self.processed_urns = set()
+    if state_file:
+      self.load_state(state_file)
+
+  def load_state(self, state_file):
+    '''
+    Incremental mode: the state is the set of URNs that were fully processed,
+    so known pages need neither metadata requests nor further paging. Without
+    state_file the state is only kept in memory.
+    '''
+    self.state_file = state_file
+    self.state = {"processed": []}
+    if state_file and os.path.isfile(state_file):
+      with open(state_file, mode='r', encoding="utf-8") as f:
+        # state files of older versions also hold the never used newest_urn
+        self.state["processed"] = json.load(f).get("processed", [])
+    self.processed_urns = set(self.state["processed"])
+
+  def save_state(self, out_dir=None):
+    '''
+    Write the state, merged with the URNs other workers processed
+    '''
+    if not self.state_file:
+      self.state["processed"] = sorted(self.processed_urns)
+      return
+    with self.shared_lock(self.state_file, out_dir):
+      try:
+        with open(self.state_file, mode='r', encoding="utf-8") as f:
+          self.processed_urns.update(json.load(f).get("processed", []))
+      except (OSError, ValueError):
+        pass
+      self.state["processed"] = sorted(self.processed_urns)
+      self.write_atomic(self.state_file, lambda f: json.dump(self.state, f, indent=1))
+
+  def write_atomic(self, filename, write):
+    '''
+    Write filename by calling write(file) on a temporary file next to it,
+    unique per process and thread, that replaces filename once written
+    '''
+    temp_file = "{}.{}-{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    try:
+      with open(temp_file, mode='w', encoding="utf-8") as f:
+        write(f)
+      os.replace(temp_file, filename)
+    except BaseException:
+      if os.path.isfile(temp_file):
+        os.remove(temp_file)
+      raise
+
+  def is_processed(self, urn, out_dir):
+    if urn in self.processed_urns:
+      return True
+    episode_info = self.catalog.by_uid(urn)
+    number = episode_info["episode"] if episode_info else None
+    return self.get_library(out_dir).find(number=number, uid=urn) is not None
+
+  def get_library(self, out_dir):
+    '''
+    Library index of out_dir, refreshed once per run
+    '''
+    if out_dir not in self.libraries:
+      library = LibraryIndex(out_dir, self.library_file)
+      self.log("Indexed output folder {} ({} directories listed)".format(out_dir, library.scanned))
+      if library.scanned:
+        # runs without new episodes never reach finish_page
+        self.save_library(library)
+      self.libraries[out_dir] = library
+    return self.libraries[out_dir]
+
+  def get_manifest(self, out_dir):
+    out_dir = os.path.abspath(out_dir)
+    if out_dir not in self.manifests:
+      self.manifests[out_dir] = LibraryManifest(out_dir)
+    return self.manifests[out_dir]
+
+  def save_library(self, library):
+    if library.index_file:
+      with self.shared_lock(library.index_file, library.directory):
+        library.save()
+
+  def save_manifest(self, out_dir):
+    # other workers merge their entries into the same file
+    with self.shared_lock(MANIFEST_NAME, out_dir):
+      self.get_manifest(out_dir).save()
+
+  def shared_lock(self, name, out_dir=None):
+    '''
+    Lock held by one of the workers at a time while it merges its changes
+    into the shared file name, a no-op unless this is one of several
+    workers. Without out_dir the work queue of the first output folder is
+    used, for the files next to the script such as the cache index.
+    '''
+    if out_dir is not None:
+      work_queue = self.get_work_queue(out_dir)
+    else:
+      work_queue = next(iter(self.work_queues.values()), None)
+    if work_queue is None:
+      return contextlib.nullcontext()
+    if name != MANIFEST_NAME:
+      name = os.path.abspath(name)
+    return work_queue.locked(name)
+
+  def get_work_queue(self, out_dir):
+    '''
+    Work queue shared with the other workers writing to out_dir, None unless
+    this is one of several workers
+    '''
+    if not self.worker_id:
+      return None
+    from work_queue import QUEUE_NAME, WorkQueue
+    out_dir = os.path.abspath(out_dir)
+    if out_dir not in self.work_queues:
+      self.work_queues[out_dir] = WorkQueue(os.path.join(out_dir, QUEUE_NAME), self.worker_id, self.lease)
+    return self.work_queues[out_dir]
+
+  def watch(self, interval, outdir=None, heartbeat_file=None, metrics_file=None):
+    '''
+    Poll the first listing page every interval seconds and download new
+    episodes as they appear. Catalog, library index, known URNs and HTTP
+    connections stay in memory between polls. SIGINT/SIGTERM stop the loop
+    after the current poll, a second signal cancels running downloads.
+    '''
+    out_dir = self.get_out_dir(outdir)
+    if out_dir is None:
+      print("Output directory {} doesn't exist".format(outdir))
+      return
+    stop = threading.Event()
+    def handle_signal(signum, frame):
+      if stop.is_set():
+        self.cancelled.set()
+      stop.set()
+    handlers = {signum: signal.signal(signum, handle_signal) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    if self.state is None:
+      self.load_state(None)
+    heartbeat = {"pid": os.getpid(), "started": time.time(), "polls": 0, "errors": 0, "downloaded": 0}
+    try:
+      while not stop.is_set():
+        self.metrics = Metrics()
+        if out_dir in self.libraries:
+          self.libraries[out_dir].refresh()
+        try:
+          cnt = self.process_maloney_episodes(1, outdir=outdir)
+          heartbeat["status"] = "ok"
+          heartbeat["downloaded"] = heartbeat["downloaded"] + len([episode for episode in self.metrics.episodes if episode["result"] == "downloaded"])
+        except Exception as err:
+          print("Polling failed: {}".format(str(err)))
+          self.metrics.count("run_failures")
+          heartbeat["status"] = "error: {}".format(str(err))
+          heartbeat["errors"] = heartbeat["errors"] + 1
+        heartbeat["polls"] = heartbeat["polls"] + 1
+        heartbeat["last_poll"] = time.time()
+        if heartbeat_file:
+          self.write_heartbeat(heartbeat_file, heartbeat)
+        if metrics_file:
+          self.metrics.write(metrics_file)
+        stop.wait(interval)
+    finally:
+      for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+    print("Stopped watching after {} polls".format(heartbeat["polls"]))
+
+  def write_heartbeat(self, heartbeat_file, heartbeat):
+    temp_file = heartbeat_file + ".tmp"
+    with open(temp_file, mode='w', encoding="utf-8") as f:
+      json.dump(heartbeat, f)
+    os.replace(temp_file, heartbeat_file)
 
   def fetch_latest(self, outdir = None, uid = None):
     self.process_maloney_episodes(1, outdir=outdir, uid=uid)
 
   def fetch_all(self, outdir = None, uid = None):
-    for i in range(1,20): # each page shows 10 items per page, iterate through pages
-      if (self.process_maloney_episodes(i, outdir=outdir, uid=uid) > 0) and uid: # if uid is set and download worked -> exit
-        return
+    if uid:
+      self.process_maloney_episodes(None, outdir, uid=uid)
+      return
+    out_dir = self.get_out_dir(outdir)
+    if out_dir is None:
+      return
+    urns = self.enumerate_urns(out_dir)
+    for batch, start in enumerate(range(0, len(urns), 10), 1):
+      self.process_urns(batch, urns[start:start + 10], out_dir, batch=True)
 
-  def process_maloney_episodes(self, page_number=1, outdir=None, uid=None):
-    # Constants
-    path_to_mid3v2   = self.path
-    mid3v2   = path_to_mid3v2 + "/mid3v2.py"
+  def enumerate_urns(self, out_dir, last_page=19):
+    '''
+    Listing stage of a backfill: fetch the listing pages, as many at once as
+    there are connections, until a page is empty or, in incremental mode,
+    completely known. Returns the URNs that are not known yet, newest first
+    and without the duplicates that episodes published in the meantime cause
+    by shifting the listing. In incremental mode page 1 is fetched alone
+    first, so a run without new episodes makes a single listing request.
+    '''
+    pages = []
+    fetched = 0
+    page_number = 1
+    while page_number <= last_page:
+      wave = 1 if self.state is not None and page_number == 1 else self.curl.concurrency()
+      page_numbers = range(page_number, min(page_number + wave, last_page + 1))
+      listed = self.get_list_urns_pages([self.episode_list_url + str(number) for number in page_numbers])
+      page_number = page_number + len(page_numbers)
+      fetched = fetched + len(page_numbers)
+      for urns in listed:
+        if not urns:
+          page_number = last_page + 1
+          break
+        pages.append(urns)
+        if self.state is not None and all(self.is_processed(urn, out_dir) for urn in urns):
+          self.log("All {} episodes on page {} were already processed".format(len(urns), len(pages)))
+          page_number = last_page + 1
+          break
 
-    temp_directory   = "./temp"
-    #json_url = "https://il.srgssr.ch/integrationlayer/2.0/srf/mediaComposition/audio/"
-    #json_url = "https://il.srgssr.ch/integrationlayer/2.0/mediaComposition/byUrn/urn:srf:audio:"
-    json_url = "https://il.srf.ch/integrationlayer/2.0/mediaComposition/byUrn/"
+    (pages, duplicates) = self.deduplicate_pages(pages)
+    self.metrics.count("duplicate_urns", duplicates)
+    urns = [urn for urns in pages for urn in urns]
+    new_urns = [urn for urn in urns if not self.is_processed(urn, out_dir)]
+    print("Fetched {} listing pages, listed {} episodes, {} duplicates removed, {} new".format(fetched, len(urns), duplicates, len(new_urns)))
+    return new_urns
 
-    episode_list_url = "https://www.srf.ch/aron/api/audio/shows/A00361/latestEpisodes?page=" + str(page_number)
+  def deduplicate_pages(self, pages):
+    '''
+    Drop URNs listed on an earlier page, returns (pages, number of duplicates)
+    '''
+    seen = set()
+    result = []
+    duplicates = 0
+    for urns in pages:
+      unique = []
+      for urn in urns:
+        if urn in seen:
+          duplicates = duplicates + 1
+        else:
+          seen.add(urn)
+          unique.append(urn)
+      result.append(unique)
+    return (result, duplicates)
 
-    # Get user constants
-    if outdir is None:
-      out_dir = "."
-    elif os.path.isdir(outdir):
-      out_dir = outdir
-    else:
-      self.log("Given output directory doesn't exist")
+  def process_maloney_episodes(self, page_number=1, outdir=None, uid=None):
+    '''
+    Returns the number of processed episodes or None if no further pages
+    should be processed
+    '''
+    out_dir = self.get_out_dir(outdir)
+    if out_dir is None:
       return None
 
     # Get page content and id's
     if uid is None:
-      urns = self.get_list_urns(episode_list_url)
+      urns = self.get_list_urns(self.episode_list_url + str(page_number))
     else:
       urns = [ 'urn:srf:audio:' + uid]
+    new_urns = self.filter_new_urns(page_number, urns, uid, out_dir)
+    if new_urns is None:
+      return None
+    if not new_urns:
+      return 0
+    return self.process_urns(page_number, new_urns, out_dir, listed=urns)
 
-    # Read JSON Data
-    json_data = self.get_jsondata(json_url, urns)
+  def process_urns(self, page_number, new_urns, out_dir, listed=None, batch=False):
+    '''
+    Resolve, download and tag new_urns, listed on page page_number or forming
+    batch page_number of a backfill. Returns the number of processed episodes.
+    '''
+    urns = listed if listed is not None else new_urns
 
-    # Download Files
-    self.log("Get Episodes")
-    # Create tmp directory
-    if not os.path.exists(temp_directory):
-      os.makedirs(temp_directory)
-    cnt = 0
-    idx = []
-    for episode in json_data:
+    library = self.get_library(out_dir)
+    self.make_temp_directory()
+    try:
+      (json_data, results) = self.run_pipeline(new_urns, out_dir, library)
+    except BaseException:
+      # keep what was downloaded before the metadata stage failed
+      try:
+        self.save_library(library)
+      finally:
+        self.save_manifest(library.directory)
+      raise
+    finally:
+      # Deleting tmp directory, unless partial downloads are left to resume
+      self.remove_temp_directory()
 
-      if episode["number"]:
-          mp3_name = "Philip Maloney - {} - {} ({}).mp3".format(episode["number"], episode["title"], episode["date"])
-      else:
-          mp3_name = "Philip Maloney - {} - {} ({}).mp3".format("xxx", episode["title"], episode["date"])
-      filename = out_dir + "/" + mp3_name
+    return self.finish_page(page_number, urns, json_data, results, library, batch=batch)
 
-      if os.path.isfile(filename):
-        self.log("  Episode \"{} ({})\" already exists in the output folder {}".format(episode["title"], episode["date"], filename))
-        self.log("    Skipping Episode ...")
-      else:
-        # Download via HTTPS
-        self.log("  HTTPS download...")
-        self.log(episode['httpsurl'])
+  def run_pipeline(self, urns, out_dir, library):
+    '''
+    Resolve the metadata of urns and download the episodes in two stages
+    joined by a bounded queue: every episode is queued as soon as its
+    metadata is parsed, and jobs download workers take episodes from the
+    queue. A full queue pauses the metadata stage, so it cannot run further
+    ahead than queue_depth episodes. Returns (json_data, results) in the
+    order of urns, results as returned or raised by process_episode.
+    '''
+    json_data = [None] * len(urns)
+    results = [None] * len(urns)
+    episodes = queue.Queue(maxsize=self.queue_depth or 2 * self.jobs)
+
+    def download():
+      while True:
+        item = episodes.get()
+        if item is None:
+          return
+        (index, episode) = item
         try:
-          mp3file = urlopen(episode['httpsurl'])
-          with open(filename,'wb') as output:
-            output.write(mp3file.read())
+          results[index] = self.process_episode(episode, out_dir, self.temp_directory, library)
         except Exception as err:
-          print("Could not download episode {}: {}".format(mp3_name, str(err)))
-          continue
-
-        idx.append(cnt)
-
-        self.log("  Adding ID3 Tags...")
-        options = []
-        options += [ '--delete-frames', '"COMM"' ]
-        options += [ '-A', '"Philip Maloney"' ]
-        options += [ '-a', '"Roger Graf"' ]
-        options += [ '-g', '"Book"' ]
-        options += [ '--TLAN', '"deu"' ]
-        options += [ '-y', '"{}"'.format(episode["date"]) ]
-        options += [ '-t', '"{} ({})"'.format(episode["title"], episode["date"]) ]
-        if episode["number"]:
-          options += [ '-T', '"{}"'.format(episode["number"]) ]
-        if episode["lead"]:
-          options += [ '-c', '"{}:{}:{}"'.format("", episode["lead"], "deu") ]
-
-        self.system_command('"{}" {} "{}"'.format(mid3v2, ' '.join(options), filename))
+          results[index] = err
+
+    def resolved(index, episode):
+      json_data[index] = episode
+      episodes.put((index, episode))
+
+    workers = [threading.Thread(target=download) for i in range(self.jobs)]
+    for worker in workers:
+      worker.start()
+    self.log("Get Episodes")
+    try:
+      self.get_jsondata(self.json_url, urns, callback=resolved)
+    except KeyboardInterrupt:
+      # let the workers finish what is queued, unless interrupted
+      self.cancelled.set()
+      raise
+    finally:
+      for worker in workers:
+        episodes.put(None)
+      for worker in workers:
+        worker.join()
+    return (json_data, results)
+
+  def get_out_dir(self, outdir):
+    if outdir is None:
+      # the script directory, as when the fetcher changed into it
+      outdir = self.path
+    if os.path.isdir(outdir):
+      # the work queue also locks the cache index shared with the other workers
+      self.get_work_queue(outdir)
+      return outdir
+    self.log("Given output directory doesn't exist")
+    return None
+
+  def filter_new_urns(self, page_number, urns, uid, out_dir):
+    '''
+    Only URNs that are neither known from earlier runs nor in the output
+    folder under their catalog uid are resolved. Returns None if no further
+    pages should be processed: the page is empty, or in incremental mode
+    everything on it is known.
+    '''
+    if uid is not None:
+      return urns
+    if not urns:
+      self.log("No episodes on page {}".format(page_number))
+      return None
+    new_urns = [urn for urn in urns if not self.is_processed(urn, out_dir)]
+    if not new_urns:
+      self.log("All {} episodes on page {} were already processed".format(len(urns), page_number))
+      return None if self.state is not None else []
+    return new_urns
 
+  def finish_page(self, page_number, urns, json_data, results, library, batch=False):
+    '''
+    Record the results of process_episode for a page and print the summary
+    '''
+    idx = []
+    cnt = 0
+    for id, downloaded in enumerate(results):
+      if isinstance(downloaded, BaseException):
+        print("Could not process episode {} ({}): {}".format(json_data[id]["title"], json_data[id]["date"], str(downloaded)))
+        continue
+      if downloaded is None:
+        continue
+      if downloaded:
+        idx.append(id)
       cnt = cnt + 1
+      if self.state is not None:
+        self.processed_urns.add(json_data[id]["urn"])
 
-    # Deleting tmp directory
-    shutil.rmtree(temp_directory)
+    # the manifest entries of downloaded episodes are kept even if the
+    # state or the library index cannot be written
+    try:
+      if self.state is not None:
+        self.save_state(library.directory)
+      self.save_library(library)
+    finally:
+      self.save_manifest(library.directory)
 
     print("------------------------------------------------------")
-    if page_number:
+    if batch:
+        print(" Finished downloading {} of {} new Episodes (batch {})".format(len(idx), len(urns), page_number))
+    elif page_number:
         print(" Finished downloading {} Episodes from page {} ({} episodes on page)".format(len(idx), page_number, len(urns)))
     else:
         print(" Finished downloading {} Episodes".format(len(idx)))
@@ -135,24 +641,462 @@ class MaloneyDownload:
     print("------------------------------------------------------")
     return cnt
 
+  def run_async(self, page_numbers, outdir=None, uid=None):
+    '''
+    Process the listing pages page_numbers, or only the episode uid, on one
+    asyncio event loop: all listing pages are requested at once, metadata of
+    a page is resolved while episodes of other pages download, and downloads
+    are limited to jobs transfers per host. Ctrl-C cancels all transfers, the
+    unfinished downloads are resumed by the next run.
+    '''
+    import asyncio
+    self.cancelled.clear()
+    try:
+      return asyncio.run(self.process_async(page_numbers, outdir, uid))
+    except KeyboardInterrupt:
+      print("Interrupted, unfinished downloads are resumed by the next run")
+      return None
+
+  async def process_async(self, page_numbers, outdir, uid):
+    import asyncio
+    out_dir = self.get_out_dir(outdir)
+    if out_dir is None:
+      return None
+    self.host_semaphores = {}
+    library = await asyncio.to_thread(self.get_library, out_dir)
+
+    if uid is None:
+      pages = await asyncio.to_thread(self.get_list_urns_pages, [self.episode_list_url + str(page_number) for page_number in page_numbers])
+      (pages, duplicates) = self.deduplicate_pages(pages)
+      self.metrics.count("duplicate_urns", duplicates)
+      if duplicates:
+        print("Removed {} duplicates listed on more than one page".format(duplicates))
+    else:
+      page_numbers = [None]
+      pages = [[ 'urn:srf:audio:' + uid]]
+
+    self.make_temp_directory()
+    tasks = [asyncio.create_task(self.process_page_async(page_number, urns, uid, out_dir, library)) for page_number, urns in zip(page_numbers, pages)]
+    cnt = 0
+    try:
+      # summaries are printed in page order, as in the synchronous path
+      for page_number, urns, task in zip(page_numbers, pages, tasks):
+        page = await task
+        if page is not None:
+          cnt = cnt + self.finish_page(page_number, urns, page[0], page[1], library)
+    except asyncio.CancelledError:
+      self.cancelled.set()
+      for task in tasks:
+        task.cancel()
+      raise
+    finally:
+      self.remove_temp_directory()
+    return cnt
+
+  async def process_page_async(self, page_number, urns, uid, out_dir, library):
+    import asyncio
+    new_urns = self.filter_new_urns(page_number, urns, uid, out_dir)
+    if not new_urns:
+      return None
+    json_data = await asyncio.to_thread(self.get_jsondata, self.json_url, new_urns)
+    self.log("Get Episodes")
+    results = await asyncio.gather(*[self.process_episode_async(episode, out_dir, library) for episode in json_data], return_exceptions=True)
+    return (json_data, results)
+
+  async def process_episode_async(self, episode, out_dir, library):
+    import asyncio
+    async with self.host_semaphore(episode["httpsurl"]):
+      return await asyncio.to_thread(self.process_episode, episode, out_dir, self.temp_directory, library)
+
+  def host_semaphore(self, url):
+    import asyncio
+    import urllib.parse
+    host = urllib.parse.urlsplit(url).netloc
+    if host not in self.host_semaphores:
+      self.host_semaphores[host] = asyncio.Semaphore(self.jobs)
+    return self.host_semaphores[host]
+
+  def process_episode(self, episode, out_dir, temp_directory, library):
+    '''
+    Download and tag a single episode, returns True if downloaded, False if
+    skipped and None if the download failed
+    '''
+    mp3_name = self.episode_filename(episode["number"], episode["title"], episode["date"])
+    filename = out_dir + "/" + mp3_name
+
+    # the number of a fuzzy match is not trusted to skip an episode
+    existing = library.find(number=None if episode.get("fuzzy") else episode["number"], title=episode["title"], uid=episode["urn"])
+    if existing:
+      self.log("  Episode \"{} ({})\" already exists in the output folder {}".format(episode["title"], episode["date"], existing))
+      self.log("    Skipping Episode ...")
+      self.metrics.count("episodes", result="skipped")
+      return False
+
+    if self.offline:
+      print("Offline, not downloading episode {}".format(mp3_name))
+      self.metrics.count("episodes", result="offline")
+      return None
+
+    work_queue = self.get_work_queue(out_dir)
+    if work_queue is None:
+      return self.download_episode(episode, filename, mp3_name, out_dir, temp_directory, library)
+    if not work_queue.claim(episode["urn"]):
+      self.log("  Episode \"{} ({})\" is claimed by another worker".format(episode["title"], episode["date"]))
+      self.metrics.count("episodes", result="claimed")
+      return None
+    try:
+      # another worker may have finished it since the output folder was indexed
+      if os.path.exists(filename):
+        self.log("  Episode \"{} ({})\" was downloaded by another worker".format(episode["title"], episode["date"]))
+        self.metrics.count("episodes", result="skipped")
+        return False
+      return self.download_episode(episode, filename, mp3_name, out_dir, temp_directory, library)
+    finally:
+      work_queue.release(episode["urn"])
+
+  def download_episode(self, episode, filename, mp3_name, out_dir, temp_directory, library):
+    '''
+    Tag and download an episode that is not in the output folder yet
+    '''
+    # The tag is written ahead of the audio, so the file is written once and never read back
+    self.log("  Building ID3 Tags...")
+    edits = []
+    edits += [ ('TALB', 'Philip Maloney') ]
+    edits += [ ('TPE1', 'Roger Graf') ]
+    edits += [ ('TCON', 'Book') ]
+    edits += [ ('TLAN', 'deu') ]
+    edits += [ ('TDRC', episode["date"]) ]
+    edits += [ ('TIT2', '{} ({})'.format(episode["title"], episode["date"])) ]
+    if episode["number"]:
+      edits += [ ('TRCK', episode["number"]) ]
+    if episode["lead"]:
+      edits += [ ('COMM', '{}:{}:{}'.format("", episode["lead"], "deu")) ]
+
+    import mid3v2
+    start = time.monotonic()
+    try:
+      tag = mid3v2.render_tag(edits, padding=self.tag_padding)
+    except Exception as err:
+      print("Could not tag episode {}: {}".format(mp3_name, str(err)))
+      self.metrics.episode(urn=episode["urn"], title=episode["title"], result="failed", error=str(err))
+      return None
+    tag_seconds = time.monotonic() - start
+    self.metrics.add_time("tagging", tag_seconds)
+
+    # Download via HTTPS into a partial file, it only gets its final name once complete
+    self.log("  HTTPS download...")
+    self.log(episode['httpsurl'])
+    part_filename = temp_directory + "/" + mp3_name + ".part"
+    start = time.monotonic()
+    try:
+      (size, sha256) = self.download_file(episode['httpsurl'], part_filename, tag)
+    except Exception as err:
+      print("Could not download episode {}: {}".format(mp3_name, str(err)))
+      if not self.cancelled.is_set() and not self.is_retryable(err):
+        self.remove_partial(part_filename)
+      self.metrics.episode(urn=episode["urn"], title=episode["title"], result="failed", error=str(err))
+      return None
+    download_seconds = time.monotonic() - start
+    self.metrics.add_time("download", download_seconds)
+
+    self.finalize_file(part_filename, filename)
+    library.add(filename, episode["number"], episode["title"], episode["urn"])
+    self.get_manifest(out_dir).add(filename, sha256, episode["urn"], episode['httpsurl'])
+    self.metrics.episode(urn=episode["urn"], title=episode["title"], result="downloaded", bytes=size,
+                         download_seconds=download_seconds, tag_seconds=tag_seconds)
+    self.metrics.count("episodes", result="downloaded")
+    self.metrics.count("download_bytes", size)
+    return True
+
+  def episode_filename(self, number, title, date):
+    if not number:
+      number = "xxx"
+    return "Philip Maloney - {} - {} ({}).mp3".format(number, title, date)
+
+  def download_file(self, url, filename, tag=b''):
+    '''
+    Download url to filename behind tag, returns the number of bytes received
+    and the SHA-256 of the audio data, as AudioHash computes it for the file.
+    A partial file left by an earlier attempt or run is resumed, failures are
+    retried with jittered exponential backoff.
+    '''
+    attempt = 0
+    while True:
+      try:
+        return self.download_attempt(url, filename, tag)
+      except Exception as err:
+        if self.cancelled.is_set() or attempt >= self.retries or not self.is_retryable(err):
+          raise
+        delay = random.uniform(0, self.retry_delay * 2 ** attempt)
+        attempt = attempt + 1
+        self.log("  Retry {} of {} in {:.1f}s for {}: {}".format(attempt, self.retries, delay, url, str(err)))
+        self.metrics.count("retries")
+        if self.cancelled.wait(delay):
+          raise InterruptedError("download cancelled")
+
+  def download_attempt(self, url, filename, tag=b''):
+    '''
+    Write tag to filename and stream the audio of url behind it in fixed-size
+    chunks. ID3 tags of the source are dropped, so tag is the only one of the
+    file. Transfers share the --max-rate bandwidth limit, and the adaptive
+    limit decides how many of them run at once.
+
+    The ETag/Last-Modified and length of the response and the size of the
+    dropped ID3v2 tag are kept next to the partial file in filename.json, so
+    a later attempt can ask for the missing bytes with Range/If-Range and
+    check the answer against them.
+    '''
+    import http.client
+    import urllib.error
+    from urllib.request import urlopen, Request
+    meta_filename = filename + ".json"
+    offset = 0
+    meta = {}
+    if os.path.isfile(filename) and os.path.isfile(meta_filename):
+      with open(meta_filename, mode='r', encoding="utf-8") as f:
+        meta = json.load(f)
+      written = os.path.getsize(filename) - len(tag)
+      if (meta.get("etag") or meta.get("last_modified")) and meta.get("source_tag") is not None and written > 0:
+        with open(filename, mode='rb') as f:
+          if f.read(len(tag)) == tag: # else the metadata changed, start over
+            offset = meta["source_tag"] + written
+    request = Request(url)
+    if offset:
+      request.add_header("Range", "bytes={}-".format(offset))
+      request.add_header("If-Range", meta.get("etag") or meta["last_modified"])
+
+    size = 0
+    sha256 = hashlib.sha256()
+    latency = None
+    status = None
+    if self.download_limit:
+      self.download_limit.acquire()
+    try:
+      start = time.monotonic()
+      try:
+        response = urlopen(request, timeout=self.timeout)
+      except urllib.error.HTTPError as err:
+        status = err.code
+        self.metrics.count("http_responses", status=err.code)
+        if err.code == 416: # range not satisfiable, start over
+          self.remove_partial(filename)
+        raise
+      latency = time.monotonic() - start
+      status = response.status
+      self.metrics.count("http_responses", status=response.status)
+      with response:
+        if response.status == 206:
+          content_range = response.headers.get("Content-Range", "")
+          range_start, length = self.parse_content_range(content_range)
+          if range_start != offset or length != meta.get("length"):
+            self.remove_partial(filename)
+            raise http.client.HTTPException("unexpected Content-Range {}, starting over".format(content_range))
+          self.log("  Resuming at byte {} of {}".format(offset, length))
+          mode = 'ab'
+          size = offset
+          audio = AudioFilter(skip=0)
+          # the only extra read pass: the audio written by an earlier attempt
+          with open(filename, mode='rb') as f:
+            f.seek(len(tag))
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+              sha256.update(chunk)
+        else:
+          length = response.headers.get("Content-Length")
+          meta = {
+            "url": url,
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", ""),
+            "length": int(length) if length else None,
+          }
+          self.write_part_meta(meta_filename, meta)
+          mode = 'wb'
+          audio = AudioFilter()
+        with open(filename, mode) as output:
+          if mode == 'wb':
+            output.write(tag)
+          while True:
+            if self.cancelled.is_set():
+              raise InterruptedError("download cancelled")
+            chunk = response.read(self.chunk_size)
+            if not chunk:
+              break
+            if self.bucket:
+              self.bucket.consume(len(chunk))
+            for piece in audio.feed(chunk):
+              output.write(piece)
+              sha256.update(piece)
+            size = size + len(chunk)
+            if meta.get("source_tag") is None and audio.tag_size is not None:
+              meta["source_tag"] = audio.tag_size
+              self.write_part_meta(meta_filename, meta)
+          if meta.get("length") and size != meta["length"]:
+            raise http.client.HTTPException("incomplete download, got {} of {} bytes".format(size, meta["length"]))
+          for piece in audio.remainder():
+            output.write(piece)
+            sha256.update(piece)
+    finally:
+      if self.download_limit:
+        self.download_limit.release(latency, status)
+    os.remove(meta_filename)
+    return (size, sha256.hexdigest())
+
+  def write_part_meta(self, meta_filename, meta):
+    with open(meta_filename, mode='w', encoding="utf-8") as f:
+      json.dump(meta, f)
+
+  def parse_content_range(self, content_range):
+    '''
+    Returns (first byte, complete length) of a "bytes 100-199/200" header
+    '''
+    try:
+      unit, byte_range = content_range.split(" ", 1)
+      first_last, length = byte_range.split("/", 1)
+      return (int(first_last.split("-", 1)[0]), int(length))
+    except ValueError:
+      return (None, None)
+
+  def is_retryable(self, err):
+    import http.client
+    import urllib.error
+    if isinstance(err, InterruptedError):
+      return False
+    if isinstance(err, urllib.error.HTTPError):
+      return err.code in (408, 416, 429) or err.code >= 500
+    import pycurl
+    if isinstance(err, pycurl.error):
+      return err.args[0] in (pycurl.E_COULDNT_RESOLVE_HOST, pycurl.E_COULDNT_CONNECT, pycurl.E_PARTIAL_FILE,
+                             pycurl.E_OPERATION_TIMEDOUT, pycurl.E_GOT_NOTHING, pycurl.E_SEND_ERROR, pycurl.E_RECV_ERROR)
+    return isinstance(err, (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError))
+
+  def remove_partial(self, part_filename):
+    for filename in (part_filename, part_filename + ".json"):
+      if os.path.isfile(filename):
+        os.remove(filename)
+
+  def make_temp_directory(self):
+    for attempt in range(3):
+      try:
+        os.makedirs(self.temp_directory, exist_ok=True)
+        return
+      except FileNotFoundError:
+        # an empty parent removed by another process at the same time
+        if attempt == 2:
+          raise
+
+  def remove_temp_directory(self):
+    # the temp directories of workers share their parent, which is left in
+    # place as other workers may be creating theirs in it
+    try:
+      os.rmdir(self.temp_directory)
+    except OSError:
+      pass
+
+  def finalize_file(self, part_filename, filename):
+    '''
+    Move a completed partial file to its final name. If the output directory is
+    on another filesystem the file is copied next to the target first, so the
+    final name never refers to an incomplete file.
+    '''
+    try:
+      os.replace(part_filename, filename)
+    except OSError:
+      import shutil
+      out_part_filename = os.path.join(os.path.dirname(filename), "." + os.path.basename(part_filename))
+      shutil.copyfile(part_filename, out_part_filename)
+      os.replace(out_part_filename, filename)
+      os.remove(part_filename)
+
   def curl_page(self, url):
-    buffer = io.BytesIO()
-    c = pycurl.Curl()
-    c.setopt(c.WRITEFUNCTION, buffer.write)
-    c.setopt(c.URL, url)
-    c.setopt(c.WRITEDATA, buffer)
-    c.setopt(pycurl.CAINFO, certifi.where())
-    c.perform()
-    c.close()
-    return buffer.getvalue().decode("utf-8")
-
-  def get_jsondata(self, jsonurl, urns):
-    json_data = []
-    for urn in urns:
-      url = jsonurl + urn + ".json"
-      page = self.curl_page(url)
-      (title, lead, httpsurl, year, date, number) = self.parse_json(page, urn)
-      json_data.append({"title": title, "lead": lead, "httpsurl":httpsurl, "year":year, "date":date, "number":number})
+    return self.curl_pages([url])[0]
+
+  def curl_pages(self, urls, callback=None):
+    '''
+    Returns the bodies of urls. If given, callback(index, body) is called for
+    every page as soon as it is available, cached ones first. Error responses
+    and failed transfers are retried like downloads.
+    '''
+    pages = [None] * len(urls)
+    requests = []
+    for index, url in enumerate(urls):
+      if self.cache is None:
+        requests.append((index, url))
+        continue
+      (body, fresh) = self.cache.lookup(url)
+      if body is not None and (fresh or self.offline):
+        self.log("  Cache hit: {}".format(url))
+        self.metrics.count("cache", result="hit")
+        pages[index] = body.decode("utf-8")
+        if callback:
+          callback(index, pages[index])
+      elif self.offline:
+        self.metrics.count("cache", result="miss")
+        raise CacheMiss("Not in cache (offline): {}".format(url))
+      else:
+        self.metrics.count("cache", result="miss" if body is None else "stale")
+        requests.append((index, url))
+
+    failures = {}
+    def received(request_index, response):
+      (index, url) = requests[request_index]
+      self.metrics.count("http_responses", status=response.status)
+      if not (200 <= response.status < 300 or response.status == 304):
+        import urllib.error
+        failures[index] = urllib.error.HTTPError(url, response.status, "HTTP Error {}".format(response.status), response.headers, None)
+        return
+      if response.status == 304 and self.cache:
+        self.log("  Cache revalidated: {}".format(url))
+        self.metrics.count("cache", result="revalidated")
+        self.cache.revalidated(url, response.headers)
+        pages[index] = self.cache.get(url).decode("utf-8")
+      else:
+        if response.status == 200 and self.cache:
+          self.cache.store(url, response.headers, response.body)
+        pages[index] = response.body.decode("utf-8")
+      if callback:
+        callback(index, pages[index])
+
+    headers = self.cache.conditional_headers if self.cache else lambda url: []
+    import pycurl
+    attempt = 0
+    try:
+      while requests:
+        failures.clear()
+        try:
+          self.curl.request_all([(url, headers(url)) for (index, url) in requests], callback=received)
+        except pycurl.error as err:
+          # request_all completes the other transfers before raising
+          failures.update((index, err) for (index, url) in requests if pages[index] is None and index not in failures)
+        requests = [(index, url) for (index, url) in requests if pages[index] is None]
+        if not requests:
+          break
+        err = failures[requests[0][0]]
+        if self.cancelled.is_set() or attempt >= self.retries or not self.is_retryable(err):
+          raise err
+        delay = random.uniform(0, self.retry_delay * 2 ** attempt)
+        attempt = attempt + 1
+        self.log("  Retry {} of {} in {:.1f}s for {} pages: {}".format(attempt, self.retries, delay, len(requests), str(err)))
+        self.metrics.count("retries", len(requests))
+        if self.cancelled.wait(delay):
+          raise InterruptedError("request cancelled")
+    finally:
+      if self.cache:
+        with self.shared_lock(self.cache.index_file()):
+          self.cache.flush()
+    return pages
+
+  def get_jsondata(self, jsonurl, urns, callback=None):
+    '''
+    Resolve the metadata of urns. If given, callback(index, episode) is
+    called for every episode as soon as its metadata is parsed.
+    '''
+    json_data = [None] * len(urns)
+    def parsed(index, page):
+      (title, lead, httpsurl, year, date, number, fuzzy) = self.parse_json(page, urns[index])
+      json_data[index] = {"urn": urns[index], "title": title, "lead": lead, "httpsurl":httpsurl, "year":year, "date":date, "number":number, "fuzzy":fuzzy}
+      if callback:
+        callback(index, json_data[index])
+    with self.metrics.phase("metadata"):
+      self.curl_pages([jsonurl + urn + ".json" for urn in urns], callback=parsed)
     return json_data
 
   def parse_json(self, json_string, uid):
@@ -172,26 +1116,55 @@ class MaloneyDownload:
     date = jsonobj['chapterList'][0]['date'][:10]
     number = ""
 
-    episode_info = next((item for item in self.episode_data if item["title"] == title), None)
-    if episode_info is None:
-        episode_info = next((item for item in self.episode_data if "alternative_titles" in item and title in item["alternative_titles"]), None)
+    (episode_info, fuzzy) = self.find_episode_info(title)
     if episode_info:
-        episode_info["lead"] = lead
-        episode_info["uid"] = uid
+        # a similar title may be another episode, only exact matches learn the uid
+        if not fuzzy:
+          self.catalog.update(episode_info, lead=lead, uid=uid)
         date = episode_info["date"]
         number = episode_info["episode"]
-    elif self.episode_data:
-        print("Could not find episode information for: {}".format(title))
 
     self.log("   Episode Info")
     self.log("      * Title    : {} Date:{}".format(title, publishedDate, year))
     self.log("      * HTTPS Url: {}".format(httpsurl))
     self.log("      * Lead     : {}".format(lead))
 
-    return (title, lead, httpsurl, year, date, number)
+    return (title, lead, httpsurl, year, date, number, fuzzy)
+
+  def find_episode_info(self, title):
+    '''
+    Returns (catalog entry, fuzzy) of an SRF title. The entry is matched
+    exactly, normalized or, if fuzzy, by trigrams with a score of at least
+    match_threshold and clearly ahead of every other entry.
+    '''
+    episode_info = self.catalog.by_title(title)
+    if episode_info is not None or not self.catalog:
+      return (episode_info, False)
+    with self.matcher_lock:
+      # built on the first title missing in the catalog, most runs never need it
+      if self.title_matcher is None:
+        self.title_matcher = TitleMatcher(self.catalog, self.match_threshold)
+    (episode_info, score, lead) = self.title_matcher.closest(title)
+    if episode_info is None:
+      print("Could not find episode information for: {}".format(title))
+      return (None, False)
+    if not self.title_matcher.accepts(score, lead):
+      print("Could not find episode information for: {} (closest: {}, score {:.2f})".format(title, episode_info["title"], score))
+      return (None, False)
+    if score < 1.0:
+      print("Matched \"{}\" to episode {} \"{}\" (score {:.2f})".format(title, episode_info["episode"], episode_info["title"], score))
+      return (episode_info, True)
+    return (episode_info, False)
 
   def get_list_urns(self, url):
-    json_string = self.curl_page(url)
+    with self.metrics.phase("listing"):
+      return self.parse_list(self.curl_page(url))
+
+  def get_list_urns_pages(self, urls):
+    with self.metrics.phase("listing"):
+      return [self.parse_list(json_string) for json_string in self.curl_pages(urls)]
+
+  def parse_list(self, json_string):
     json_string = unicodedata.normalize('NFKD', json_string).encode('utf-8','ignore')
     jsonobj = json.loads(json_string)
     urns = []
@@ -199,10 +1172,6 @@ class MaloneyDownload:
         urns.append(episode.get('assetUrn'))
     return urns
 
-  def system_command(self, command):
-    self.log(command)
-    os.system(command)
-
   def log(self, message):
     if self.verbose:
       print(message)
@@ -217,24 +1186,73 @@ if __name__ == "__main__":
   parser.add_argument('-l', '--latest', action='store_true', dest="latest", help='Download the last 10 Maloney episodes, works also for the newest ones ;-).')
   parser.add_argument('-o', '--outdir', dest='outdir', help='Specify directory to store episodes to.')
   parser.add_argument('-u', '--uid', dest='uid', help='Download a single episode by providing SRF stream UID.')
-  parser.add_argument('-j', '--json-data', dest='json', help='Use episode info from json file.')
-  parser.add_argument('-w', '--write-json', action='store_true', dest="json_write", help='Store json data.')
+  parser.add_argument('-j', '--json-data', dest='json', help='Use episode info from json file or SQLite database (.db, .sqlite).')
+  parser.add_argument('-w', '--write-json', action='store_true', dest="json_write", help='Store json data, a SQLite database is updated as episodes are resolved.')
+  parser.add_argument('-J', '--jobs', type=int, default=1, dest='jobs', help='Number of episodes to download and tag in parallel.')
+  parser.add_argument('--max-connections', type=int, default=4, dest='max_connections', help='Number of concurrent metadata requests.')
+  parser.add_argument('--cache-dir', dest='cache_dir', default='./cache', help='Directory to cache SRF metadata in.')
+  parser.add_argument('--no-cache', action='store_const', const=None, dest='cache_dir', help='Disable the metadata cache.')
+  parser.add_argument('--cache-size', type=int, default=50, dest='cache_size', help='Maximum size of the metadata cache in MB.')
+  parser.add_argument('--offline', action='store_true', dest='offline', help='Only use cached metadata, do not access the network.')
+  parser.add_argument('-i', '--incremental', action='store_true', dest='incremental', help='Skip episodes processed by earlier runs and stop at the first fully known page.')
+  parser.add_argument('--state-file', dest='state_file', default='./state.json', help='File to keep the URNs processed in incremental mode in.')
+  parser.add_argument('--library-file', dest='library_file', default='./library.json', help='File to keep the index of the output directory in.')
+  parser.add_argument('--async', action='store_true', dest='use_async', help='Fetch listing pages, metadata and episodes concurrently on an asyncio event loop.')
+  parser.add_argument('--metrics', dest='metrics', help='Write run metrics to this file, as Prometheus textfile if it ends in .prom, else as JSON lines.')
+  parser.add_argument('--max-rate', type=int, dest='max_rate', help='Limit the total download bandwidth to MAX_RATE KB/s.')
+  parser.add_argument('--no-adaptive', action='store_false', dest='adaptive', help='Do not reduce concurrency when SRF answers slowly or with 429/5xx.')
+  parser.add_argument('--retries', type=int, default=3, dest='retries', help='Number of retries for a failed request or episode download.')
+  parser.add_argument('--timeout', type=int, default=30, dest='timeout', help='Seconds to wait for a connection or for data on a stalled transfer before it is retried.')
+  parser.add_argument('--watch', type=float, dest='watch', metavar='INTERVAL', help='Keep running and poll for new episodes every INTERVAL seconds.')
+  parser.add_argument('--heartbeat', dest='heartbeat', help='With --watch, update this file after every poll.')
+  parser.add_argument('--episode-list-url', dest='episode_list_url', help='Base URL of the episode listing pages, for mirrors and benchmark.py.')
+  parser.add_argument('--json-url', dest='json_url', help='Base URL of the episode metadata, for mirrors and benchmark.py.')
+  parser.add_argument('--worker', dest='worker_id', metavar='ID', help='Share the output directory with other workers: episodes are claimed through lease files, ID names this worker and its temp directory.')
+  parser.add_argument('--lease', type=int, default=300, dest='lease', help='With --worker, seconds until the claims of a crashed worker expire.')
+  parser.add_argument('--match-threshold', type=float, default=0.9, dest='match_threshold', help='Minimum similarity (0-1) of SRF and catalog titles that differ by more than case, accents and punctuation.')
   parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Enable verbose.')
   args = parser.parse_args()
+  # relative paths are relative to the script location, as they always were
+  path = os.path.split(os.path.realpath(__file__))[0]
+  for option in ('outdir', 'json', 'cache_dir', 'state_file', 'library_file', 'metrics', 'heartbeat'):
+    if getattr(args, option):
+      setattr(args, option, os.path.join(path, getattr(args, option)))
+  # without -o episodes are stored next to the script
+  args.outdir = args.outdir or path
+  if args.offline and not args.cache_dir:
+    parser.error('--offline needs the metadata cache, do not combine it with --no-cache')
 
   latest = args.latest
 
-  maloney_downloader = MaloneyDownload(verbose=args.verbose, episode_json_file = args.json)
+  maloney_downloader = MaloneyDownload(verbose=args.verbose, episode_json_file = args.json, jobs = args.jobs, max_connections = args.max_connections,
+                                       cache_dir = args.cache_dir, cache_size = args.cache_size * 1024 * 1024, offline = args.offline,
+                                       state_file = args.state_file if args.incremental else None,
+                                       library_file = args.library_file, write_catalog = args.json_write,
+                                       max_rate = args.max_rate * 1024 if args.max_rate else None, adaptive = args.adaptive,
+                                       retries = args.retries, timeout = args.timeout, json_url = args.json_url, episode_list_url = args.episode_list_url,
+                                       worker_id = args.worker_id, lease = args.lease, match_threshold = args.match_threshold)
 
-  if args.uid:
-    maloney_downloader.process_maloney_episodes(None, args.outdir, uid=args.uid)
-  elif latest:
-    maloney_downloader.fetch_latest(outdir = args.outdir, uid=args.uid)
-  else: # default setting
-    maloney_downloader.fetch_all(outdir = args.outdir, uid=args.uid)
+  if args.watch:
+    # writes the metrics of every poll itself
+    maloney_downloader.watch(args.watch, outdir = args.outdir, heartbeat_file = args.heartbeat, metrics_file = args.metrics)
+  else:
+    try:
+      if args.use_async:
+        pages = [1] if latest else range(1,20)
+        maloney_downloader.run_async(pages, outdir = args.outdir, uid=args.uid)
+      elif args.uid:
+        maloney_downloader.process_maloney_episodes(None, args.outdir, uid=args.uid)
+      elif latest:
+        maloney_downloader.fetch_latest(outdir = args.outdir, uid=args.uid)
+      else: # default setting
+        maloney_downloader.fetch_all(outdir = args.outdir, uid=args.uid)
+    except BaseException:
+      maloney_downloader.metrics.count("run_failures")
+      raise
+    finally:
+      if args.metrics:
+        maloney_downloader.metrics.write(args.metrics)
 
   if args.json_write:
     if os.path.isfile(args.json):
-        with open(args.json, mode='w') as f:
-            json = json.dumps(maloney_downloader.episode_data)
-            f.write(json)
+        maloney_downloader.catalog.save(args.json)
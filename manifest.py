@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+
+MANIFEST_NAME = '.maloney-manifest.json'
+ID3V1_SIZE = 128
+
+class AudioFilter:
+    '''
+    Passes the audio of an MP3 stream fed in chunks and drops its leading
+    ID3v2 and trailing ID3v1 tag
+
+    feed() returns the audio of a chunk as a list of buffers. The last 128
+    bytes are held back, remainder() returns them unless they are an ID3v1
+    tag. tag_size is the size of the dropped ID3v2 tag once known. A stream
+    resumed behind its ID3v2 tag is filtered with skip=0.
+    '''
+
+    def __init__(self, skip=None):
+        self.head = b''
+        self.skip = skip
+        self.tag_size = skip
+        self.tail = b''
+
+    def feed(self, data):
+        if self.skip is None:
+            # wait for the complete 10 byte ID3v2 header
+            self.head = self.head + data
+            if len(self.head) < 10:
+                return []
+            data = self.head
+            self.head = b''
+            self.skip = self.tag_size = id3v2_size(data[:10])
+        if self.skip:
+            skipped = min(self.skip, len(data))
+            data = data[skipped:]
+            self.skip = self.skip - skipped
+        if len(data) >= ID3V1_SIZE:
+            pieces = [self.tail, memoryview(data)[:-ID3V1_SIZE]]
+            self.tail = bytes(data[-ID3V1_SIZE:])
+            return pieces
+        data = self.tail + data
+        self.tail = data[-ID3V1_SIZE:]
+        return [data[:-ID3V1_SIZE]]
+
+    def remainder(self):
+        # shorter than an ID3v2 header, so there was no tag to drop
+        pieces = [self.head]
+        if not (len(self.tail) == ID3V1_SIZE and self.tail.startswith(b'TAG')):
+            pieces.append(self.tail)
+        return pieces
+
+class AudioHash:
+    '''
+    SHA-256 of an MP3 stream without its leading ID3v2 and trailing ID3v1 tag,
+    so retagging a file does not change its hash
+    '''
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.audio = AudioFilter()
+
+    def update(self, data):
+        for piece in self.audio.feed(data):
+            self.sha256.update(piece)
+
+    def hexdigest(self):
+        sha256 = self.sha256.copy()
+        for piece in self.audio.remainder():
+            sha256.update(piece)
+        return sha256.hexdigest()
+
+def id3v2_size(header):
+    '''
+    Size of the ID3v2 tag starting with header, 0 if there is none
+    '''
+    if header[:3] != b'ID3' or any(byte & 0x80 for byte in header[6:10]):
+        return 0
+    size = 0
+    for byte in header[6:10]: # syncsafe integer, 7 bits per byte
+        size = size * 128 + byte
+    if header[5] & 0x10: # footer
+        size = size + 10
+    return size + 10
+
+def hash_file(path, chunk_size=1024 * 1024):
+    '''
+    Returns (size, mtime, audio hash) of a file
+    '''
+    audio_hash = AudioHash()
+    with open(path, mode='rb') as file:
+        stat = os.fstat(file.fileno())
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            audio_hash.update(chunk)
+    return (stat.st_size, stat.st_mtime, audio_hash.hexdigest())
+
+class LibraryManifest:
+    '''
+    Size, mtime, audio hash, URN and source URL of every episode downloaded
+    into a directory, kept in .maloney-manifest.json in that directory
+
+    save() merges the entries changed since loading into the file as it is
+    on disk, so processes writing to the same directory keep each other's
+    entries. They must not save at the same time.
+    '''
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.manifest_file = os.path.join(self.directory, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.files = self.load()
+        self.changed = set()
+
+    def load(self):
+        if not os.path.isfile(self.manifest_file):
+            return {}
+        with open(self.manifest_file, mode='r', encoding="utf-8") as file:
+            return json.load(file).get("files", {})
+
+    def add(self, path, sha256, urn="", url=""):
+        stat = os.stat(path)
+        relpath = os.path.relpath(os.path.abspath(path), self.directory)
+        with self.lock:
+            self.files[relpath] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha256": sha256,
+                "urn": urn,
+                "url": url,
+            }
+            self.changed.add(relpath)
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            files = self.load()
+            files.update((relpath, self.files[relpath]) for relpath in self.changed)
+            # unique per process and thread, verify may run next to a download
+            temp_file = "{}.{}-{}.tmp".format(self.manifest_file, os.getpid(), threading.get_ident())
+            try:
+                with open(temp_file, mode='w', encoding="utf-8") as file:
+                    json.dump({"files": files}, file, indent=1, sort_keys=True)
+                os.replace(temp_file, self.manifest_file)
+            except OSError:
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+                raise
+            self.files = files
+            self.changed = set()
+
+    def verify(self, jobs=None, full=False):
+        '''
+        Check every file of the manifest. Files whose size and mtime are
+        unchanged are trusted unless full is set, the others are rehashed on a
+        process pool. Returns a list of (relpath, status) with status ok,
+        retagged, truncated, corrupt or missing. Retagged files get their new
+        size and mtime recorded.
+        '''
+        results = []
+        rehash = []
+        for relpath, entry in sorted(self.files.items()):
+            try:
+                stat = os.stat(os.path.join(self.directory, relpath))
+            except OSError:
+                results.append((relpath, "missing"))
+                continue
+            if not full and stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]:
+                results.append((relpath, "ok"))
+            else:
+                rehash.append(relpath)
+
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            hashes = executor.map(hash_file, [os.path.join(self.directory, relpath) for relpath in rehash], chunksize=4)
+            for relpath, (size, mtime, sha256) in zip(rehash, hashes):
+                entry = self.files[relpath]
+                if sha256 == entry["sha256"]:
+                    status = "ok"
+                    if size != entry["size"] or mtime != entry["mtime"]:
+                        status = "retagged"
+                        with self.lock:
+                            entry.update(size=size, mtime=mtime)
+                            self.changed.add(relpath)
+                elif size < entry["size"]:
+                    status = "truncated"
+                else:
+                    status = "corrupt"
+                results.append((relpath, status))
+        return sorted(results)
+
+    def untracked(self):
+        '''
+        MP3 files in the directory that are not in the manifest
+        '''
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.lower().endswith('.mp3') and name not in self.files)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Check downloaded episodes against the integrity manifest of their folder')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    verify_parser = subparsers.add_parser('verify', help='Rehash files whose size or mtime changed since they were downloaded.')
+    verify_parser.add_argument('directory', help='Output folder of maloney_streamfetcher.py')
+    verify_parser.add_argument('-J', '--jobs', type=int, dest='jobs', help='Number of hashing processes (default: number of CPUs).')
+    verify_parser.add_argument('--full', action='store_true', dest='full', help='Rehash all files, also unchanged ones.')
+    verify_parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Also list files that are ok.')
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.directory, MANIFEST_NAME)):
+        sys.exit("No manifest in {}".format(args.directory))
+    manifest = LibraryManifest(args.directory)
+    results = manifest.verify(jobs=args.jobs, full=args.full)
+    manifest.save()
+
+    counts = {}
+    for relpath, status in results:
+        counts[status] = counts.get(status, 0) + 1
+        if status != "ok" or args.verbose:
+            print("{:<10} {}".format(status, relpath))
+    untracked = manifest.untracked()
+    for name in untracked if args.verbose else []:
+        print("{:<10} {}".format("untracked", name))
+    print("Checked {} files: {}, {} untracked".format(
+        len(results), ", ".join("{} {}".format(count, status) for status, count in sorted(counts.items())) or "none", len(untracked)))
+    if any(status in ("truncated", "corrupt", "missing") for relpath, status in results):
+        sys.exit(1)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+class Metrics:
+    '''
+    Phase timings, counters and per-episode figures of a fetcher run
+
+    write() appends JSON lines to the given file, or writes a Prometheus
+    textfile-collector file if its name ends in .prom.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.episodes = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def episode(self, **fields):
+        if fields.get("download_seconds") and fields.get("bytes"):
+            fields["bytes_per_second"] = fields["bytes"] / fields["download_seconds"]
+        with self.lock:
+            self.episodes.append(fields)
+
+    def write(self, filename):
+        if filename.endswith('.prom'):
+            self.write_prometheus(filename)
+        else:
+            self.write_json_lines(filename)
+
+    def write_json_lines(self, filename):
+        now = time.time()
+        with self.lock:
+            lines = [dict(type="episode", time=now, **episode) for episode in self.episodes]
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters[name + ''.join('{{{}={}}}'.format(*label) for label in labels)] = value
+            lines.append({
+                "type": "run",
+                "time": now,
+                "run_seconds": now - self.start,
+                "phase_seconds": self.phases,
+                "counters": counters,
+            })
+        with open(filename, mode='a', encoding="utf-8") as file:
+            for line in lines:
+                file.write(json.dumps(line) + "\n")
+
+    def write_prometheus(self, filename):
+        now = time.time()
+        lines = []
+        lines.append('# HELP maloney_last_run_timestamp_seconds End of the last fetcher run.')
+        lines.append('# TYPE maloney_last_run_timestamp_seconds gauge')
+        lines.append('maloney_last_run_timestamp_seconds {}'.format(now))
+        lines.append('# HELP maloney_run_seconds Wall time of the last fetcher run.')
+        lines.append('# TYPE maloney_run_seconds gauge')
+        lines.append('maloney_run_seconds {}'.format(now - self.start))
+        with self.lock:
+            lines.append('# HELP maloney_phase_seconds Time spent per phase in the last run, summed over workers.')
+            lines.append('# TYPE maloney_phase_seconds gauge')
+            for name, seconds in sorted(self.phases.items()):
+                lines.append('maloney_phase_seconds{{phase="{}"}} {}'.format(name, seconds))
+            names = sorted(set(name for name, labels in self.counters))
+            for name in names:
+                lines.append('# TYPE maloney_{} gauge'.format(name))
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter != name:
+                        continue
+                    label_string = ','.join('{}="{}"'.format(*label) for label in labels)
+                    lines.append('maloney_{}{} {}'.format(name, '{' + label_string + '}' if label_string else '', value))
+            downloaded = [episode for episode in self.episodes if episode.get("bytes")]
+            seconds = sum(episode.get("download_seconds", 0) for episode in downloaded)
+        lines.append('# HELP maloney_download_bytes_per_second Mean throughput of the episode downloads in the last run.')
+        lines.append('# TYPE maloney_download_bytes_per_second gauge')
+        lines.append('maloney_download_bytes_per_second {}'.format(sum(episode["bytes"] for episode in downloaded) / seconds if seconds else 0))
+        # the textfile collector may read at any time, replace the file atomically
+        temp_file = filename + '.tmp'
+        with open(temp_file, mode='w', encoding="utf-8") as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, filename)
@@ -6,9 +6,12 @@
 # it under the terms of version 2 of the GNU General Public License as
 # published by the Free Software Foundation.
 
+import io
 import sys
+import json
 import locale
 import codecs
+import concurrent.futures
 
 from optparse import OptionParser, SUPPRESS_HELP
 
@@ -18,7 +21,7 @@ import mutagen.id3
 VERSION = (1, 3)
 
 global verbose
-verbose = True
+verbose = False
 
 
 def getpreferredencoding(*args):
@@ -122,7 +125,7 @@ def delete_frames(deletes, filenames):
         except mutagen.id3.ID3NoHeaderError:
             if verbose:
                 print("No ID3 header found; skipping.")
-        except StandardError as err:
+        except Exception as err:
             print(str(err))
         else:
             for frame in frames:
@@ -130,7 +133,7 @@ def delete_frames(deletes, filenames):
             id3.save()
 
 
-def write_files(edits, filenames, escape):
+def decode_edits(edits, escape):
     enc = getpreferredencoding()
 
     # unescape escape sequences and decode values
@@ -158,13 +161,19 @@ def write_files(edits, filenames, escape):
             raise SystemExit(1)
 
         encoded_edits.append((frame, value))
-    edits = encoded_edits
+    return encoded_edits
+
+
+def apply_edits(id3, edits, escape):
+    """Add the (frame, value) pairs in edits to the loaded tag id3"""
 
     # preprocess:
     #   for all [frame,value] pairs in the edits list
     #      gather values for identical frames into a list
     tmp = {}
     for frame, value in edits:
+        if not value:
+            continue
         if frame in tmp:
             tmp[frame].append(value)
         else:
@@ -178,62 +187,182 @@ def write_files(edits, filenames, escape):
     else:
         string_split = lambda s, *args, **kwargs: s.split(*args, **kwargs)
 
+    for (frame, vlist) in edits.items():
+        if frame == "POPM":
+            for value in vlist:
+                values = string_split(value, ":")
+                if len(values) == 1:
+                    email, rating, count = values[0], 0, 0
+                elif len(values) == 2:
+                    email, rating, count = values[0], values[1], 0
+                else:
+                    email, rating, count = values
+
+                frame = mutagen.id3.POPM(
+                    email=email, rating=int(rating), count=int(count))
+                id3.add(frame)
+
+        elif frame == "COMM":
+            for value in vlist:
+                values = string_split(value, ":")
+                if len(values) == 1:
+                    value, desc, lang = values[0], "", "eng"
+                elif len(values) == 2:
+                    desc, value, lang = values[0], values[1], "eng"
+                else:
+                    value = ":".join(values[1:-1])
+                    desc, lang = values[0], values[-1]
+                frame = mutagen.id3.COMM(
+                    encoding=3, text=value, lang=lang, desc=desc)
+                id3.add(frame)
+        elif frame == "TXXX":
+            for value in vlist:
+                values = string_split(value, ":", 1)
+                if len(values) == 1:
+                    desc, value = "", values[0]
+                else:
+                    desc, value = values[0], values[1]
+                frame = mutagen.id3.TXXX(encoding=3, text=value, desc=desc)
+                id3.add(frame)
+        elif issubclass(mutagen.id3.Frames[frame], mutagen.id3.UrlFrame):
+            frame = mutagen.id3.Frames[frame](encoding=3, url=vlist)
+            id3.add(frame)
+        else:
+            frame = mutagen.id3.Frames[frame](encoding=3, text=vlist)
+            id3.add(frame)
+
+
+def load_tag(filename):
+    try:
+        return mutagen.id3.ID3(filename)
+    except mutagen.id3.ID3NoHeaderError:
+        if verbose:
+            print("No ID3 header found; creating a new tag")
+        return mutagen.id3.ID3()
+
+
+def tag_file(filename, edits, deletes=(), escape=False, id3=None):
+    """Delete the frames in deletes and apply the (frame, value) pairs in
+    edits to filename, with one load and one save of the file. A tag that
+    was already loaded with load_tag can be passed as id3.
+
+    Frame IDs are given without the leading "--", e.g.
+        tag_file("a.mp3", [("TIT2", "Title")], deletes=["COMM"])
+    """
+    if id3 is None:
+        id3 = load_tag(filename)
+    for frame in deletes:
+        id3.delall(frame)
+    apply_edits(id3, edits, escape)
+    id3.save(filename)
+
+
+def render_tag(edits, padding=4096, escape=False):
+    """Return a new ID3v2.4 tag with the (frame, value) pairs in edits as
+    bytes, followed by padding bytes of padding, to be written in front of
+    the audio of a new file.
+    """
+    id3 = mutagen.id3.ID3()
+    apply_edits(id3, edits, escape)
+    output = io.BytesIO()
+    id3.save(output, v1=0, v2_version=4, padding=lambda info: padding)
+    return output.getvalue()
+
+
+def write_files(edits, filenames, escape, deletes=()):
+    edits = decode_edits(edits, escape)
+
     for filename in filenames:
         if verbose:
             print("Writing", filename)
         try:
-            id3 = mutagen.id3.ID3(filename)
-        except mutagen.id3.ID3NoHeaderError:
-            if verbose:
-                print("No ID3 header found; creating a new tag")
-            id3 = mutagen.id3.ID3()
-        except StandardError as err:
+            tag_file(filename, edits, deletes, escape)
+        except Exception as err:
             print(str(err))
             continue
-        for (frame, vlist) in edits.items():
-            if frame == "POPM":
-                for value in vlist:
-                    values = string_split(value, ":")
-                    if len(values) == 1:
-                        email, rating, count = values[0], 0, 0
-                    elif len(values) == 2:
-                        email, rating, count = values[0], values[1], 0
-                    else:
-                        email, rating, count = values
-
-                    frame = mutagen.id3.POPM(
-                        email=email, rating=int(rating), count=int(count))
-                    id3.add(frame)
-
-            elif frame == "COMM":
-                for value in vlist:
-                    values = string_split(value, ":")
-                    if len(values) == 1:
-                        value, desc, lang = values[0], "", "eng"
-                    elif len(values) == 2:
-                        desc, value, lang = values[0], values[1], "eng"
-                    else:
-                        value = ":".join(values[1:-1])
-                        desc, lang = values[0], values[-1]
-                    frame = mutagen.id3.COMM(
-                        encoding=3, text=value, lang=lang, desc=desc)
-                    id3.add(frame)
-            elif frame == "TXXX":
-                for value in vlist:
-                    values = string_split(value, ":", 1)
-                    if len(values) == 1:
-                        desc, value = "", values[0]
-                    else:
-                        desc, value = values[0], values[1]
-                    frame = mutagen.id3.TXXX(encoding=3, text=value, desc=desc)
-                    id3.add(frame)
-            elif issubclass(mutagen.id3.Frames[frame], mutagen.id3.UrlFrame):
-                frame = mutagen.id3.Frames[frame](encoding=3, url=vlist)
-                id3.add(frame)
+
+
+def read_manifest(manifest):
+    """Parse a JSONL manifest of {"file", "deletes", "edits"} records.
+
+    deletes is a list of frame IDs or a comma separated string, edits a list
+    of [frame, value] pairs or an object mapping frames to a value or a list
+    of values. Returns a list of (line number, record or error) tuples."""
+    if manifest == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(manifest, encoding="utf-8") as fileobj:
+            lines = fileobj.readlines()
+
+    records = []
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            filename = record["file"]
+            deletes = record.get("deletes", [])
+            if isinstance(deletes, str):
+                deletes = [frame for frame in deletes.split(",") if frame]
+            edits = record.get("edits", [])
+            if isinstance(edits, dict):
+                pairs = []
+                for frame, values in edits.items():
+                    if not isinstance(values, list):
+                        values = [values]
+                    pairs += [(frame, value) for value in values]
+                edits = pairs
             else:
-                frame = mutagen.id3.Frames[frame](encoding=3, text=vlist)
-                id3.add(frame)
-        id3.save(filename)
+                edits = [(frame, value) for frame, value in edits]
+        except (ValueError, KeyError, TypeError) as err:
+            records.append((lineno, ValueError("invalid record: %s" % err)))
+        else:
+            records.append((lineno, (filename, deletes, edits)))
+    return records
+
+
+def tag_file_records(filename, changes, escape=False):
+    """Apply a list of (deletes, edits) to filename in order, as tag_file
+    would one after the other, but with one load and one save of the file."""
+    id3 = load_tag(filename)
+    for deletes, edits in changes:
+        for frame in deletes:
+            id3.delall(frame)
+        apply_edits(id3, edits, escape)
+    id3.save(filename)
+
+
+def apply_manifest(manifest, escape, jobs=1):
+    """Apply every manifest record with one load and one save per file, on
+    jobs worker threads. Records of the same file are applied in manifest
+    order by the same job. Returns the number of failed records."""
+    records = read_manifest(manifest)
+    files = {}
+    failures = 0
+    for lineno, record in records:
+        if isinstance(record, Exception):
+            print("%s:%d: %s" % (manifest, lineno, record))
+            failures += 1
+        else:
+            filename, deletes, edits = record
+            files.setdefault(filename, []).append((deletes, edits))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [executor.submit(tag_file_records, filename, changes, escape)
+                   for filename, changes in files.items()]
+
+    for (filename, changes), future in zip(files.items(), futures):
+        try:
+            future.result()
+        except Exception as err:
+            print("%s: %s" % (filename, str(err)))
+            failures += len(changes)
+        else:
+            if verbose:
+                print("Writing", filename)
+    if verbose:
+        print("%d records applied, %d failed" % (len(records) - failures, failures))
+    return failures
 
 
 def list_tags(filenames):
@@ -242,7 +371,7 @@ def list_tags(filenames):
         print("IDv2 tag info for %s:" % filename)
         try:
             id3 = mutagen.id3.ID3(filename, translate=False)
-        except StandardError as err:
+        except Exception as err:
             print(str(err))
         else:
             print(id3.pprint().encode(enc, "replace"))
@@ -253,7 +382,7 @@ def list_tags_raw(filenames):
         print("Raw IDv2 tag info for %s:" % filename)
         try:
             id3 = mutagen.id3.ID3(filename, translate=False)
-        except StandardError as err:
+        except Exception as err:
             print(str(err))
         else:
             for frame in id3.values():
@@ -298,6 +427,13 @@ def main(argv):
     parser.add_option(
         '--delete-frames', metavar='FID1,FID2,...', action='store',
         dest='deletes', default='', help="Delete the given frames")
+    parser.add_option(
+        "--manifest", metavar="FILE", action="store", dest="manifest",
+        help="Apply the {file, deletes, edits} records of a JSONL file "
+             "(- for stdin), with a single load and save per file")
+    parser.add_option(
+        "-j", "--jobs", metavar="N", action="store", type="int", dest="jobs",
+        default=1, help="Number of files tagged in parallel with --manifest")
     parser.add_option(
         "-C", "--convert", action="store_const", dest="action",
         const="convert",
@@ -345,12 +481,17 @@ def main(argv):
     global verbose
     verbose = options.verbose
 
+    if options.manifest:
+        failures = apply_manifest(options.manifest, options.escape, options.jobs)
+        raise SystemExit(1 if failures else 0)
+
     if args:
         if parser.edits or options.deletes:
-            if options.deletes:
-                delete_frames(options.deletes, args)
             if parser.edits:
-                write_files(parser.edits, args, options.escape)
+                deletes = options.deletes.split(",") if options.deletes else []
+                write_files(parser.edits, args, options.escape, deletes)
+            else:
+                delete_frames(options.deletes, args)
         elif options.action in [None, 'list']:
             list_tags(args)
         elif options.action == "list-raw":
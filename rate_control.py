@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+class TokenBucket:
+    '''
+    Bandwidth limit shared by all transfers: every byte takes a token, tokens
+    refill at rate bytes per second up to burst
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst else rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        Take amount tokens, blocking until they are available. Amounts above the
+        burst size are taken as debt, which later consumers wait for.
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+class AdaptiveLimit:
+    '''
+    Number of requests allowed in flight, adapted by additive increase and
+    multiplicative decrease: halved when the server answers 429/5xx or the
+    latency rises well above the best seen so far, raised by one after a full
+    window of healthy responses
+    '''
+
+    def __init__(self, maximum, minimum=1, latency_factor=3.0):
+        self.maximum = max(1, maximum)
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = self.maximum
+        self.latency_factor = latency_factor
+        self.best_latency = None
+        self.successes = 0
+        self.in_flight = 0
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self, latency=None, status=None):
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.record(latency, status)
+            self.condition.notify_all()
+
+    def record(self, latency=None, status=None):
+        '''
+        Adapt the limit to the outcome of a request, latency in seconds. A
+        request without latency and status never got an answer.
+        '''
+        with self.condition:
+            if status is None:
+                overloaded = latency is None
+            else:
+                overloaded = status == 429 or status >= 500
+            if latency is not None and not overloaded:
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                elif latency > self.best_latency * self.latency_factor and latency > 0.05:
+                    overloaded = True
+            if overloaded:
+                self.successes = 0
+                if self.limit > self.minimum:
+                    self.limit = max(self.minimum, self.limit // 2)
+                    self.decreased = self.decreased + 1
+            else:
+                self.successes = self.successes + 1
+                if self.successes >= self.limit and self.limit < self.maximum:
+                    self.limit = self.limit + 1
+                    self.successes = 0
+            self.condition.notify_all()
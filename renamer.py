@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 
 import os
+import glob
 import argparse
+import concurrent.futures
 import unicodedata
-import json
-import mutagen
-import mutagen.id3
+import mid3v2
+import tag_scanner
+from episode_catalog import open_catalog, TitleMatcher
 
 class MaloneyRenamer:
     '''
@@ -14,34 +16,38 @@ class MaloneyRenamer:
 
     path = './'
     verbose = False
-    episode_data = []
-    mid3v2 = ''
+    catalog = None
+    title_matcher = None
 
-    def __init__(self, verbose=False, episode_json_file=''):
+    def __init__(self, verbose=False, episode_json_file='', match_threshold=0.9):
         # Change to script location
         path = os.path.split(os.path.realpath(__file__))[0]
         self.path = path
-        self.mid3v2 = path + '/mid3v2.py'
         self.verbose = verbose
         if not episode_json_file:
             episode_json_file = path + '/episode-data.json'
-        if os.path.isfile(episode_json_file):
-            with open(episode_json_file, mode='r', encoding="utf-8") as file:
-                json_string = file.read()
-                json_string = unicodedata.normalize('NFKD', json_string).encode('utf-8','ignore')
-                self.episode_data = json.loads(json_string)
+        self.catalog = open_catalog(episode_json_file)
+        self.title_matcher = TitleMatcher(self.catalog, match_threshold)
 
     def log(self, message):
         if self.verbose:
             print(message)
 
-    def system_command(self, command):
-        self.log(command)
-        os.system(command)
-
     def process_file(self, filename):
+        plan = self.plan_file(filename)
+        if plan is not None:
+            self.apply_plan(filename, plan)
+
+    def plan_file(self, filename, dry_run=False):
+        '''
+        Returns (new_filename, edits, id3) for filename or None if it cannot be
+        renamed. Files that are not named by uid, episode number or title are
+        identified by TRCK, and last by the most similar catalog title. id3 is
+        the tag loaded to read TRCK, so it is not parsed a second time for
+        writing. A dry run only reads TRCK with the header-only tag scanner.
+        '''
         if not os.path.isfile(filename):
-            return
+            return None
 
         path = os.path.dirname(filename)
         base = os.path.basename(filename)
@@ -50,68 +56,132 @@ class MaloneyRenamer:
 
         if not ext == '.mp3':
             print("Can only rename .mp3: {}".format(filename))
-            return
+            return None
 
         stem = unicodedata.normalize('NFKD', stem).encode('utf-8','ignore').decode('utf-8')
-        episode_info = None
-        if episode_info is None:
-            episode_info = next((item for item in self.episode_data if "uid" in item and item["uid"] == stem), None)
-        if episode_info is None:
-            episode_info = next((item for item in self.episode_data if item["episode"] == stem), None)
+        title = stem
+        id3 = None
+        episode_info = self.catalog.by_uid(stem)
         if episode_info is None:
-            episode_info = next((item for item in self.episode_data if item["title"] == stem), None)
+            episode_info = self.catalog.by_episode(stem)
         if episode_info is None:
-            episode_info = next((item for item in self.episode_data if "alternative_titles" in item and stem in item["alternative_titles"]), None)
+            episode_info = self.catalog.by_title(stem)
         if episode_info is None:
             try:
-                id3 = mutagen.id3.ID3(filename, translate=False)
+                if dry_run:
+                    track = tag_scanner.read_tag(filename)[1].get('TRCK', '')
+                else:
+                    id3 = mid3v2.load_tag(filename)
+                    track = str(id3['TRCK']) if 'TRCK' in id3 else ''
             except Exception as err:
                 print(str(err))
             else:
-                for frame in id3.values():
-                    if frame.FrameID == 'TRCK':
-                        stem = str(+frame).zfill(3)
-                        episode_info = next((item for item in self.episode_data if item["episode"] == stem), None)
-
-        if not episode_info is None:
-            date = episode_info["date"]
-            number = episode_info["episode"]
-            lead = ''
-            if "lead" in episode_info:
-                lead = episode_info["lead"]
-            title = episode_info["title"]
-            mp3_name = "Philip Maloney - {} - {} ({}).mp3".format(number, title, date)
-
-            if path:
-                new_filename = "{}/{}".format(path, mp3_name)
-            else:
-                new_filename = mp3_name
-            os.rename(filename, new_filename)
-
-            self.log("  Adding ID3 Tags...")
-            options = []
-            options += [ '--delete-frames', '"COMM"' ]
-            options += [ '-A', '"Philip Maloney"' ]
-            options += [ '-a', '"Roger Graf"' ]
-            options += [ '-g', '"Book"' ]
-            options += [ '--TLAN', '"deu"' ]
-            options += [ '-y', '"{}"'.format(date) ]
-            options += [ '-t', '"{} ({})"'.format(title, date) ]
-            options += [ '-T', '"{}"'.format(number) ]
-            if lead:
-                options += [ '-c', '"{}:{}:{}"'.format("", lead, "deu") ]
-
-            self.system_command('"{}" {} "{}"'.format(self.mid3v2, ' '.join(options), new_filename))
-        else:
+                track = track.split('/')[0].strip()
+                if track.isdigit():
+                    stem = str(int(track)).zfill(3)
+                    episode_info = self.catalog.by_episode(stem)
+        if episode_info is None:
+            (episode_info, score, lead) = self.title_matcher.closest(title)
+            if episode_info is not None and not self.title_matcher.accepts(score, lead):
+                self.log("Closest title for {}: {} (score {:.2f})".format(title, episode_info["title"], score))
+                episode_info = None
+            elif episode_info is not None and score < 1.0:
+                print("Matched {} to episode {} \"{}\" (score {:.2f})".format(title, episode_info["episode"], episode_info["title"], score))
+
+        if episode_info is None:
             print("Could not find info for: {}".format(stem))
+            return None
+
+        date = episode_info["date"]
+        number = episode_info["episode"]
+        lead = ''
+        if "lead" in episode_info:
+            lead = episode_info["lead"]
+        title = episode_info["title"]
+        mp3_name = "Philip Maloney - {} - {} ({}).mp3".format(number, title, date)
+
+        if path:
+            new_filename = "{}/{}".format(path, mp3_name)
+        else:
+            new_filename = mp3_name
+
+        edits = []
+        edits += [ ('TALB', 'Philip Maloney') ]
+        edits += [ ('TPE1', 'Roger Graf') ]
+        edits += [ ('TCON', 'Book') ]
+        edits += [ ('TLAN', 'deu') ]
+        edits += [ ('TDRC', date) ]
+        edits += [ ('TIT2', '{} ({})'.format(title, date)) ]
+        edits += [ ('TRCK', number) ]
+        if lead:
+            edits += [ ('COMM', '{}:{}:{}'.format("", lead, "deu")) ]
+
+        return (new_filename, edits, id3)
+
+    def apply_plan(self, filename, plan):
+        (new_filename, edits, id3) = plan
+        os.rename(filename, new_filename)
+
+        self.log("  Adding ID3 Tags...")
+        try:
+            mid3v2.tag_file(new_filename, edits, deletes=['COMM'], id3=id3)
+        except Exception as err:
+            print("Could not tag {}: {}".format(new_filename, str(err)))
+
+    def expand_paths(self, paths):
+        '''
+        Files, directories (searched recursively for .mp3) and glob patterns
+        '''
+        filenames = []
+        for path in paths:
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    filenames += [os.path.join(root, name) for name in sorted(files) if name.lower().endswith('.mp3')]
+            elif glob.has_magic(path):
+                filenames += sorted(glob.glob(path, recursive=True))
+            else:
+                filenames.append(path)
+        return filenames
+
+    def process_files(self, paths, jobs=1, dry_run=False):
+        '''
+        Plan all files on a pool of jobs workers, then rename and retag them.
+        With dry_run the plan is only printed.
+        '''
+        filenames = self.expand_paths(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            plans = list(executor.map(lambda filename: self.plan_file(filename, dry_run), filenames))
+
+        work = []
+        targets = {}
+        for filename, plan in zip(filenames, plans):
+            if plan is None:
+                continue
+            new_filename = plan[0]
+            if new_filename in targets:
+                print("Skipping {}: {} is already renamed to {}".format(filename, targets[new_filename], new_filename))
+                continue
+            targets[new_filename] = filename
+            if dry_run:
+                print("{} -> {}".format(filename, new_filename))
+                for frame, value in plan[1]:
+                    print("    {}={}".format(frame, value))
+            else:
+                work.append((filename, plan))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(lambda item: self.apply_plan(*item), work))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = 'Options for renamer script')
-    parser.add_argument('-j', '--json-data', dest='json', help='Use episode info from json file.', default='')
+    parser.add_argument('-j', '--json-data', dest='json', help='Use episode info from json file or SQLite database (.db, .sqlite).', default='')
+    parser.add_argument('-J', '--jobs', type=int, default=1, dest='jobs', help='Number of files to process in parallel.')
+    parser.add_argument('-n', '--dry-run', action='store_true', dest='dry_run', help='Only print how files would be renamed and tagged.')
+    parser.add_argument('--match-threshold', type=float, default=0.9, dest='match_threshold', help='Minimum similarity (0-1) of file and catalog titles that differ by more than case, accents and punctuation.')
     parser.add_argument('-v', '--verbose', action='store_true', dest='verbose', help='Enable verbose.')
-    parser.add_argument('files', nargs='*')
+    parser.add_argument('files', nargs='*', help='Files, directories or glob patterns.')
     args = parser.parse_args()
 
-    renamer = MaloneyRenamer(verbose=args.verbose, episode_json_file = args.json)
-    for mp3file in args.files:
-        renamer.process_file(filename=mp3file)
+    renamer = MaloneyRenamer(verbose=args.verbose, episode_json_file = args.json, match_threshold = args.match_threshold)
+    renamer.process_files(args.files, jobs=args.jobs, dry_run=args.dry_run)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import mmap
+import argparse
+import concurrent.futures
+from library_index import normalize_title
+
+FRAMES = ('TIT2', 'TRCK', 'TDRC', 'COMM', 'TALB')
+# ID3v2.2 and ID3v2.3 names of the frames
+FRAME_ALIASES = {
+    'TT2': 'TIT2', 'TRK': 'TRCK', 'TYE': 'TDRC', 'COM': 'COMM', 'TAL': 'TALB',
+    'TYER': 'TDRC',
+}
+ENCODINGS = {0: ('latin-1', b'\x00'), 1: ('utf-16', b'\x00\x00'), 2: ('utf-16-be', b'\x00\x00'), 3: ('utf-8', b'\x00')}
+FIELDS = ('path', 'size', 'mtime', 'version') + FRAMES
+
+def syncsafe(data):
+    value = 0
+    for byte in data:
+        value = value * 128 + (byte & 0x7f)
+    return value
+
+def remove_unsynchronisation(data):
+    return data.replace(b'\xff\x00', b'\xff')
+
+def split_text(data, terminator):
+    '''
+    Splits at terminators that start on a character boundary
+    '''
+    width = len(terminator)
+    parts = []
+    start = 0
+    for offset in range(0, len(data) - width + 1, width):
+        if data[offset:offset + width] == terminator and offset >= start:
+            parts.append(data[start:offset])
+            start = offset + width
+    parts.append(data[start:])
+    return parts
+
+def decode_text(data, encoding):
+    (codec, terminator) = ENCODINGS.get(encoding, ENCODINGS[0])
+    values = [part.decode(codec, 'replace') for part in split_text(data, terminator)]
+    # text frames may end in a terminator, and utf-16 values may be bare BOMs
+    return '/'.join(value.lstrip('\ufeff') for value in values if value.lstrip('\ufeff'))
+
+def decode_frame(frame_id, data):
+    if not data:
+        return None
+    encoding = data[0]
+    if frame_id == 'COMM':
+        # encoding, language, description, text
+        (codec, terminator) = ENCODINGS.get(encoding, ENCODINGS[0])
+        parts = split_text(data[4:], terminator)
+        description = parts[0].decode(codec, 'replace').lstrip('\ufeff')
+        return (description, decode_text(terminator.join(parts[1:]), encoding))
+    return decode_text(data[1:], encoding)
+
+def parse_frames(tag, version):
+    '''
+    Yields (frame id, raw data) of the wanted frames in an ID3v2 tag body
+    '''
+    offset = 0
+    id_size = 3 if version == 2 else 4
+    header_size = 6 if version == 2 else 10
+    while offset + header_size <= len(tag):
+        frame_id = tag[offset:offset + id_size].decode('latin-1')
+        if not frame_id.strip('\x00') or not frame_id.isalnum():
+            break # padding
+        if version == 2:
+            size = int.from_bytes(tag[offset + 3:offset + 6], 'big')
+            flags = 0
+        elif version == 3:
+            size = int.from_bytes(tag[offset + 4:offset + 8], 'big')
+            flags = int.from_bytes(tag[offset + 8:offset + 10], 'big')
+        else:
+            size = syncsafe(tag[offset + 4:offset + 8])
+            flags = int.from_bytes(tag[offset + 8:offset + 10], 'big')
+        data = tag[offset + header_size:offset + header_size + size]
+        offset = offset + header_size + size
+        name = FRAME_ALIASES.get(frame_id, frame_id)
+        if name not in FRAMES:
+            continue
+        if version == 3:
+            if flags & 0x00c0: # compressed or encrypted
+                continue
+        elif version == 4:
+            if flags & 0x000c: # compressed or encrypted
+                continue
+            if flags & 0x0002:
+                data = remove_unsynchronisation(data[4:] if flags & 0x0001 else data)
+            elif flags & 0x0001: # data length indicator
+                data = data[4:]
+        yield (name, data)
+
+def read_tag(path):
+    '''
+    Returns (ID3v2 version, {frame: value}) for the frames in FRAMES. Only the
+    tag at the start of the file is mapped into memory, the audio is never
+    read.
+    '''
+    with open(path, mode='rb') as file:
+        header = file.read(10)
+        if len(header) < 10 or header[:3] != b'ID3' or header[3] not in (2, 3, 4):
+            return (None, {})
+        (version, flags) = (header[3], header[5])
+        end = min(10 + syncsafe(header[6:10]), os.fstat(file.fileno()).st_size)
+        with mmap.mmap(file.fileno(), end, access=mmap.ACCESS_READ) as region:
+            tag = region[10:end]
+    if flags & 0x80 and version < 4:
+        tag = remove_unsynchronisation(tag)
+    if flags & 0x40 and version == 3:
+        tag = tag[4 + int.from_bytes(tag[:4], 'big'):]
+    elif flags & 0x40 and version == 4:
+        tag = tag[syncsafe(tag[:4]):]
+
+    values = {}
+    for name, data in parse_frames(tag, version):
+        value = decode_frame(name, data)
+        if value is None:
+            continue
+        if name == 'COMM':
+            # the comment without description is the one the fetcher writes
+            (description, text) = value
+            if name not in values or not description:
+                values[name] = text
+        else:
+            values.setdefault(name, value)
+    return ("2.{}".format(version), values)
+
+def scan_file(path):
+    entry = {'path': path}
+    try:
+        stat = os.stat(path)
+        entry.update(size=stat.st_size, mtime=stat.st_mtime)
+        (entry['version'], values) = read_tag(path)
+    except (OSError, ValueError) as err:
+        (entry['version'], values) = (None, {'error': str(err)})
+    entry.update(values)
+    return entry
+
+def find_files(paths):
+    '''
+    Files and directories, searched recursively for .mp3
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith('.mp3'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def scan(paths, jobs=8):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        return list(executor.map(scan_file, find_files(paths)))
+
+def episode_keys(entry):
+    '''
+    Episode number of TRCK and the normalized title, without the date fetcher
+    and renamer append to TIT2
+    '''
+    keys = []
+    track = entry.get('TRCK', '').split('/')[0].strip()
+    if track.isdigit():
+        keys.append('episode:{}'.format(int(track)))
+    title = entry.get('TIT2', '')
+    if title.endswith(')') and ' (' in title:
+        title = title[:title.rindex(' (')]
+    if normalize_title(title):
+        keys.append('title:{}'.format(normalize_title(title)))
+    return keys
+
+def duplicates(entries):
+    '''
+    Entries that share an episode number or a title with another one, each
+    with the number of its group in "duplicate"
+    '''
+    parents = list(range(len(entries)))
+    def root(index):
+        while parents[index] != index:
+            index = parents[index]
+        return index
+    owners = {}
+    for index, entry in enumerate(entries):
+        for key in episode_keys(entry):
+            if key in owners:
+                parents[root(index)] = root(owners[key])
+            else:
+                owners[key] = index
+    groups = {}
+    for index in range(len(entries)):
+        groups.setdefault(root(index), []).append(index)
+    result = []
+    for number, members in enumerate([members for members in groups.values() if len(members) > 1], 1):
+        result += [dict(entries[index], duplicate=number) for index in members]
+    return result
+
+def write_entries(entries, output, output_format):
+    if output_format == 'json':
+        json.dump(entries, output, indent=1, ensure_ascii=False)
+        output.write('\n')
+        return
+    fields = FIELDS + tuple(sorted(set(key for entry in entries for key in entry) - set(FIELDS)))
+    writer = csv.DictWriter(output, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(entries)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Read the ID3v2 frames TIT2, TRCK, TDRC, COMM and TALB of many MP3 files')
+    parser.add_argument('-f', '--format', choices=['json', 'csv'], default='json', dest='format', help='Output format.')
+    parser.add_argument('-o', '--output', dest='output', help='Write to this file instead of stdout.')
+    parser.add_argument('-J', '--jobs', type=int, default=8, dest='jobs', help='Number of files to read in parallel.')
+    parser.add_argument('-d', '--duplicates', action='store_true', dest='duplicates', help='Only list files of episodes found more than once, by TRCK or title.')
+    parser.add_argument('paths', nargs='+', help='Files or directories.')
+    args = parser.parse_args()
+
+    entries = scan(args.paths, jobs=args.jobs)
+    if args.duplicates:
+        entries = duplicates(entries)
+    if args.output:
+        with open(args.output, mode='w', encoding="utf-8", newline='') as output:
+            write_entries(entries, output, args.format)
+    else:
+        write_entries(entries, sys.stdout, args.format)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import argparse
+import threading
+import contextlib
+
+QUEUE_NAME = '.maloney-queue'
+
+class WorkQueue:
+    '''
+    Lease files in a directory shared by several workers, e.g. on a NAS, so
+    every item is worked on by one worker at a time
+
+    A worker claims an item by creating its lease file exclusively. Leases
+    expire after lease seconds unless renewed, held leases are renewed by a
+    background thread, so the claims of a crashed worker are released once
+    their lease ran out. Expiry is compared to the clock of every worker,
+    their clocks should be synchronized to well below lease seconds.
+    '''
+
+    def __init__(self, directory, worker_id=None, lease=300):
+        self.directory = os.path.abspath(directory)
+        self.worker_id = worker_id or socket.gethostname()
+        # unique per process, also for overlapping runs with the same worker_id
+        self.owner = "{}-{}-{}".format(self.worker_id, os.getpid(), os.urandom(4).hex())
+        self.lease = lease
+        self.lock = threading.Lock()
+        self.held = {}
+        self.stopped = threading.Event()
+        self.renewer = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def lease_file(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + '.lease')
+
+    def read_lease(self, lease_file):
+        try:
+            with open(lease_file, mode='r', encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            # gone, or created but not written yet
+            return None
+
+    def write_lease(self, file, key):
+        lease = {"key": key, "owner": self.owner, "host": socket.gethostname(), "pid": os.getpid(),
+                 "expires": time.time() + self.lease}
+        file.write(json.dumps(lease))
+
+    def claim(self, key):
+        '''
+        Returns True if the lease of key was acquired, False if another worker
+        holds it
+        '''
+        lease_file = self.lease_file(key)
+        for attempt in range(2):
+            try:
+                fd = os.open(lease_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            except FileExistsError:
+                lease = self.read_lease(lease_file)
+                if lease is None:
+                    # being written by its owner right now, unless it crashed
+                    try:
+                        expires = os.path.getmtime(lease_file) + self.lease
+                    except OSError:
+                        continue
+                else:
+                    expires = lease["expires"]
+                if expires > time.time():
+                    return False
+                self.break_lease(lease_file)
+                continue
+            with os.fdopen(fd, mode='w', encoding="utf-8") as file:
+                self.write_lease(file, key)
+            with self.lock:
+                self.held[key] = lease_file
+                if self.renewer is None:
+                    self.renewer = threading.Thread(target=self.renew_leases, daemon=True)
+                    self.renewer.start()
+            return True
+        return False
+
+    def break_lease(self, lease_file):
+        '''
+        Remove an expired lease. It is renamed away first, so of several
+        workers breaking it only one succeeds, and a lease claimed again in
+        the meantime is put back.
+        '''
+        stale_file = "{}.{}.stale".format(lease_file, self.owner)
+        try:
+            os.rename(lease_file, stale_file)
+        except OSError:
+            return
+        lease = self.read_lease(stale_file)
+        if lease is not None and lease["expires"] > time.time():
+            try:
+                os.link(stale_file, lease_file)
+            except OSError:
+                pass
+        os.remove(stale_file)
+
+    def renew(self, key):
+        '''
+        Extend the lease of key, returns False if it was lost to another worker
+        '''
+        # under the lock, so a released lease is not written again
+        with self.lock:
+            lease_file = self.held.get(key)
+            if lease_file is None:
+                return False
+            lease = self.read_lease(lease_file)
+            if lease is None or lease["owner"] != self.owner:
+                self.held.pop(key, None)
+                return False
+            temp_file = "{}.{}.tmp".format(lease_file, self.owner)
+            with open(temp_file, mode='w', encoding="utf-8") as file:
+                self.write_lease(file, key)
+            os.replace(temp_file, lease_file)
+            return True
+
+    def renew_leases(self):
+        while not self.stopped.wait(self.lease / 3):
+            with self.lock:
+                keys = list(self.held)
+            for key in keys:
+                try:
+                    if not self.renew(key):
+                        print("Lost the lease of {} to another worker".format(key))
+                except OSError as err:
+                    print("Could not renew the lease of {}: {}".format(key, str(err)))
+
+    def release(self, key):
+        with self.lock:
+            lease_file = self.held.pop(key, None)
+            if lease_file is None:
+                return
+            lease = self.read_lease(lease_file)
+            if lease is not None and lease["owner"] == self.owner:
+                try:
+                    os.remove(lease_file)
+                except OSError:
+                    pass
+
+    @contextlib.contextmanager
+    def locked(self, key, poll=0.1):
+        '''
+        Hold the lease of key for the duration of a with block, waiting for
+        other workers to release it or for it to expire
+        '''
+        while not self.claim(key):
+            time.sleep(poll)
+        try:
+            yield
+        finally:
+            self.release(key)
+
+    def close(self):
+        '''
+        Stop renewing and release all held leases
+        '''
+        self.stopped.set()
+        for key in list(self.held):
+            self.release(key)
+
+    def leases(self):
+        '''
+        All leases in the directory, as written by their workers
+        '''
+        result = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.lease'):
+                lease = self.read_lease(os.path.join(self.directory, name))
+                if lease is not None:
+                    result.append(lease)
+        return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'List the episodes claimed by workers sharing an output folder')
+    parser.add_argument('directory', help='Output folder of maloney_streamfetcher.py')
+    args = parser.parse_args()
+
+    queue_directory = os.path.join(args.directory, QUEUE_NAME)
+    if not os.path.isdir(queue_directory):
+        sys.exit("No work queue in {}".format(args.directory))
+    now = time.time()
+    for lease in WorkQueue(queue_directory).leases():
+        state = "expired" if lease["expires"] <= now else "{:.0f}s left".format(lease["expires"] - now)
+        print("{:<40} {:<30} {}".format(lease["key"], lease["owner"], state))